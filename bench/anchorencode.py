@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Section ids and self-links per second, the table-driven anchorencode_href()
+against the per-character encoder it replaced.
+
+    python -m bench.anchorencode [--db PATH] [--titles 200000]
+
+The titles are the headings of the pages in the database given with --db
+(the HEADINGS column of arch_manpages), or synthetic ones: mostly ASCII,
+some with roff leftovers, brackets and percent signs, some in other scripts.
+Both encoders must give the same result for every title.
+"""
+import argparse
+import json
+import random
+import re
+import sqlite3
+import time
+import unicodedata
+
+from indexer import util
+
+WORDS = ["DESCRIPTION", "OPTIONS", "SEE ALSO", "EXIT STATUS", "Shell Grammar", "[EXPR]", "100%", "a|b", "x_y", " ",
+    "BESCHREIBUNG", "ОПИСАНИЕ", "説明", "Ωmega", "tab\there", "no\u00a0break", "\u200bzero", " :lead", "%41"]
+
+
+def reference_href(str_):
+    """
+    anchorencode_href() of an id, as it was before the table
+    """
+    str_ = re.sub(r"%([a-fA-F0-9]{2})", r"%25\g<1>", str_)
+    output = ""
+    for char in str_:
+        if char in "[]|" or unicodedata.category(char)[0] in {"Z", "C"}:
+            for byte in bytes(char, "utf-8", "strict"):
+                output += "{}{:02X}".format("%", byte)
+        else:
+            output += char
+    return output
+
+
+def reference_id(str_):
+    str_ = str_.replace("_", " ").strip()
+    str_ = re.sub("[ ]+", " ", str_).lstrip(":")
+    return re.sub("[ \t\n\r\f\v]", "_", str_)
+
+
+def reference(title: str) -> str:
+    id = "".join({"<": "&lt;", ">": "&gt;", "\"": "&quot;", "'": "&apos;", "&": "&amp;"}.get(c, c) for c in reference_id(title))
+    return reference_href(id)
+
+
+def table(title: str) -> str:
+    # what _section_heading() does with a title
+    return util.anchorencode_href(util.safe_escape_attribute(util.anchorencode_id(title)), input_is_already_id=True)
+
+
+def titles_from_db(path: str) -> list:
+    con = sqlite3.connect(path)
+    titles = []
+    for headings, in con.execute("SELECT HEADINGS FROM arch_manpages WHERE HEADINGS IS NOT NULL"):
+        titles += [heading["title"] for heading in json.loads(headings)]
+    con.close()
+    return titles
+
+
+def synthetic(rng: random.Random, count: int) -> list:
+    return [" ".join(rng.choices(WORDS[:5], k=rng.randint(1, 3))) if rng.random() < 0.8 else
+        " ".join(rng.choices(WORDS, k=rng.randint(1, 4))) for _ in range(count)]
+
+
+def measure(encode, titles: list) -> float:
+    start = time.perf_counter()
+    for title in titles:
+        encode(title)
+    return len(titles) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="index database to take the headings from")
+    parser.add_argument("--titles", type=int, default=200000, help="synthetic titles, without --db")
+    args = parser.parse_args()
+
+    titles = titles_from_db(args.db) if args.db else synthetic(random.Random(0), args.titles)
+    for title in titles:
+        assert table(title) == reference(title), f"ids differ for {title!r}"
+    ascii = sum(title.isascii() for title in titles)
+    print(f"same ids for {len(titles)} titles, {ascii} of them ASCII")
+
+    print(f"{'':<14}{'titles/s':>12}")
+    for name, encode in (("per character", reference), ("table", table)):
+        print(f"{name:<14}{measure(encode, titles):>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
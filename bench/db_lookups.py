@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Per-request latency of the man page routes, before and after the indexes
+created by Indexer._migrate_db.
+
+    python -m bench.db_lookups [--pages 100000] [--requests 2000]
+
+A synthetic database is generated in a temporary directory, the real
+database is not touched.
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from indexer.indexer import Indexer
+from web import create_app
+
+LOCALES = ["de", "fr", "ru", "ja", "pl", "es", "it"]
+INDEXES = ["arch_manpages_name_section_locale", "arch_manpages_locale", "arch_manpages_package", "arch_redirects_source",
+    "arch_manpages_repo_name_section_locale", "arch_manpages_section_name_locale"]
+
+
+def populate(db: str, pages: int, page_size: int):
+    indexer = Indexer("core", db)
+    con = indexer._con
+    rng = random.Random(0)
+    filler = "x" * page_size
+
+    packages = [(f"pkg{i}", "core", "1.0-1", f"pkg{i}-1.0-1-x86_64.pkg.tar.zst", "x86_64", "https://example.com", "GPL", "", "[]", None) for i in range(pages // 20 + 1)]
+    con.executemany("INSERT INTO arch_packages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", packages)
+
+    rows = []
+    for i in range(pages):
+        section = str(rng.randint(1, 8))
+        locale = "en" if rng.random() < 0.85 else rng.choice(LOCALES)
+        mandir = f"man{section}" if locale == "en" else f"{locale}/man{section}"
+        rows.append((i, f"pkg{i // 20}", "core", f"usr/share/man/{mandir}/page{i}.{section}", f"page{i}", section, locale, "[]", "description"))
+    con.executemany("""INSERT INTO arch_manpages (ID, PACKAGE, REPO, FILENAME, NAME, SECTION, LOCALE, HEADINGS, DESCRIPTION)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+    con.executemany("""INSERT INTO arch_contents (ID, ENCODING, CONTENT, HTML_CONTENT, TXT_CONTENT)
+    VALUES (?, NULL, ?, ?, ?)""", ((row[0], filler, filler, filler) for row in rows))
+
+    redirects = [(f"alias{i}", row[5], row[6], row[4], row[5], row[6]) for i, row in enumerate(rows[::5])]
+    con.executemany("INSERT INTO arch_redirects (SOURCE_NAME, SOURCE_SECTION, SOURCE_LANG, TARGET_NAME, TARGET_SECTION, TARGET_LANG) VALUES (?, ?, ?, ?, ?, ?)", redirects)
+    con.commit()
+    return indexer, rows
+
+
+def urls(rows: list, count: int) -> dict:
+    rng = random.Random(1)
+    sample = [rng.choice(rows) for _ in range(count)]
+    return {
+        "name": [f"/man/{row[4]}" for row in sample],
+        "name.section": [f"/man/{row[4]}.{row[5]}" for row in sample],
+        "name.lang": [f"/man/{row[4]}.{row[6]}" for row in sample],
+        "name.section.lang": [f"/man/{row[4]}.{row[5]}.{row[6]}" for row in sample],
+        "missing": [f"/man/missing{i}.1" for i in range(count)],
+    }
+
+
+def measure(client, paths: list) -> list:
+    timings = []
+    for path in paths:
+        start = time.perf_counter()
+        client.get(path)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(label: str, results: dict):
+    print(f"\n{label}")
+    print(f"{'url':<20}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for kind, timings in results.items():
+        timings = sorted(timings)
+        p95 = timings[int(len(timings) * 0.95)]
+        print(f"{kind:<20}{statistics.mean(timings):>10.3f}{statistics.median(timings):>10.3f}{p95:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per url kind")
+    parser.add_argument("--page-size", type=int, default=1000, help="bytes per content column")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, "packages.db")
+        indexer, rows = populate(db, args.pages, args.page_size)
+        # without the response cache, repeated urls would measure the cache instead of the queries
+        app = create_app({"DATABASE": db, "RESPONSE_CACHE_BYTES": 0})
+        client = app.test_client()
+        paths = urls(rows, args.requests)
+
+        for index in INDEXES:
+            indexer._db.execute(f"DROP INDEX IF EXISTS {index}")
+        indexer._con.commit()
+        report(f"without indexes ({args.pages} pages)", {kind: measure(client, p) for kind, p in paths.items()})
+
+        indexer._migrate_db()
+        indexer._con.commit()
+        report(f"with indexes ({args.pages} pages)", {kind: measure(client, p) for kind, p in paths.items()})
+        indexer._con.close()
+
+
+if __name__ == "__main__":
+    main()
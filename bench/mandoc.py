@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Pages per second rendered by each way of running mandoc.
+
+    python -m bench.mandoc [--pages 3000] [--paragraphs 20]
+
+Every page is converted to html and txt, like the indexer does:
+
+    shell    a /bin/sh and a mandoc per conversion (the old mandoc_convert)
+    spawn    a mandoc per conversion, without a shell
+    mandocd  one long-lived mandocd per format, skipped if it isn't installed
+
+The pages are synthetic, with the usual sections, font macros and lists.
+"""
+import argparse
+import random
+import shutil
+import subprocess
+import time
+
+from indexer import mandoc
+
+WORDS = "the file is read from standard input and written to output when option given print each line of all entries".split()
+
+
+def page(rng: random.Random, i: int, paragraphs: int) -> str:
+    lines = [f'.TH PAGE{i} 1 2024-01-01 "bench" "General Commands Manual"', ".SH NAME", f"page{i} \\- {' '.join(rng.choices(WORDS, k=6))}",
+        ".SH SYNOPSIS", f".B page{i}", "[\\fB\\-abc\\fR] [\\fIfile\\fR ...]", ".SH DESCRIPTION"]
+    for _ in range(paragraphs):
+        lines += [".PP", " ".join(rng.choices(WORDS, k=40)), f".B {rng.choice(WORDS)}", " ".join(rng.choices(WORDS, k=20))]
+    lines += [".SH OPTIONS"]
+    for option in "abc":
+        lines += [".TP", f".B \\-{option}", " ".join(rng.choices(WORDS, k=15))]
+    lines += [".SH SEE ALSO", ".BR ls (1),", ".BR man (7)"]
+    return "\n".join(lines) + "\n"
+
+
+def shell(content: str, fmt: str) -> str:
+    cmd = "mandoc -T html -O fragment" if fmt == "html" else "mandoc -T utf8"
+    return subprocess.run(cmd, shell=True, check=True, input=content, encoding="utf-8", stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+
+
+def measure(convert, pages: list) -> float:
+    start = time.perf_counter()
+    for content in pages:
+        convert(content, "html")
+        convert(content, "txt")
+    return len(pages) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=3000)
+    parser.add_argument("--paragraphs", type=int, default=20, help="DESCRIPTION paragraphs per page")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    pages = [page(rng, i, args.paragraphs) for i in range(args.pages)]
+    print(f"{args.pages} pages, {sum(map(len, pages)) / len(pages) / 1024:.1f} KiB on average")
+
+    backends = {"shell": shell, "spawn": mandoc.spawn}
+    daemons = {}
+    if shutil.which("mandocd") is not None:
+        daemons = {fmt: mandoc.Mandocd(fmt) for fmt in mandoc.ARGUMENTS}
+        backends["mandocd"] = lambda content, fmt: daemons[fmt].convert(content)
+        # same output as mandoc itself
+        for content in pages[:20]:
+            for fmt in mandoc.ARGUMENTS:
+                assert daemons[fmt].convert(content) == mandoc.spawn(content, fmt), f"mandocd output differs ({fmt})"
+    else:
+        print("mandocd not found, skipped")
+
+    print(f"{'backend':<12}{'pages/s':>10}")
+    for name, convert in backends.items():
+        print(f"{name:<12}{measure(convert, pages):>10.1f}")
+    for daemon in daemons.values():
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
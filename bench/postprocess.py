@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Postprocessing of the html output of mandoc: the single pass against the
+regex chain it replaced.
+
+    python -m bench.postprocess [--pages 20] [--sections 30] [--fuzz 20000]
+
+The output of both is compared first, on large pages and on small pages made
+of random markup fragments (--fuzz), including the ones the single pass
+leaves to the chain. Then both are timed on the large pages, which are
+synthetic mandoc output the size of bash(1) or perlfunc(1).
+"""
+import argparse
+import random
+import time
+
+from indexer import util
+
+WORDS = "the file is read from standard input and written to output when option given print each line of all entries".split()
+
+# pieces of mandoc output and the odd cases of each transform
+FRAGMENTS = [
+    "word ", " ", "\n", "&nbsp;", "&lt;", "&gt;", "(1)", "(3p)", "(8)x", ".",
+    "<b>", "</b>", "<i>", "</i>", "<em>", "</em>", "<strong>", "</strong>", "<mark>", "</mark>",
+    "<b>ls</b>", "<i>printf</i>(3)", "<b>ls</b>(1)", "<b>a b</b>(1)", "<b class=\"Nm\">x</b>(1)",
+    "<p class=\"Pp\">", "</p>", "<p></p>", "<p> </p>\n", "<span>&nbsp;</span>", "<b> </b>", "<br/>", "<br/>\n", "\n<br/>",
+    "<div class=\"Bd\">", "</div>", "</div>\n<br/>", "<pre>", "</pre>", "<pre>\n  a\n    b\n</pre>", "<pre class=\"x\">", "<pre></pre>",
+    "<a href=\"#x\">", "</a>", "<a class=\"Lk\" href=\"http://a.b/\">http://a.b/</a>", "<abbr>", "</abbr>",
+    "<h1 class=\"Sh\" id=\"x\">", "</h1>", "<h2 class=\"Ss\">", "</h2>", "<h1>", "<a class=\"permalink\" href=\"#x\">", "<a class='permalink'>",
+    "<h1 class=\"Sh\" id=\"N\"><a class=\"permalink\" href=\"#N\">NAME</a></h1>",
+    "<h1 class=\"Sh\" id=\"D\"><a class=\"permalink\" href=\"#D\">DESCRIPTION &amp; MORE</a></h1>",
+    "<h1 class=\"Sh\" id=\"D\"><a class=\"permalink\" href=\"#D\">DESCRIPTION &amp; MORE</a></h1>",
+    "<h2 class=\"Ss\" id=\"s\">\n<a class=\"permalink\" href=\"#s\">Sub\nsection</a>\n</h2>",
+    "<h1 class=\"Sh\"><a class=\"permalink\" href=\"#e\"> </a></h1>", "<h1 id=\"x\"><a class=\"permalink\" href=\"#x\"><i>x</i> y</a></h1>",
+    "http://example.org/", "https://example.org/a_b.", "http://x", "see http://a.b/c, and", "&lt;http://a.b/c&gt;", "&lt;http://a.b/c.&gt;",
+    "<b>http://a.b/c</b>", "<b> https://a.b/ </b>", "&lt;<i>http://a.b/c</i>&gt;", "<br/>http://a.b</b>", "<pre>http://a.b/c</pre>",
+    "<pre>\n  https://a.b/c\n</pre>", "<strong class=\"s\">http://x.y/</strong>", "<em>http://x.y/ z</em>", "<tt>http://x.y</tt>",
+    "<td class=\"x\">", "</td>", "<>",
+]
+
+
+def text(rng: random.Random, k: int) -> str:
+    out = []
+    for _ in range(k):
+        r = rng.random()
+        w = rng.choice(WORDS)
+        if r < 0.05:
+            out.append(f"<b>{w}</b>")
+        elif r < 0.08:
+            out.append(f"<i>{w}</i>")
+        elif r < 0.09:
+            out.append(f"<b>{w}</b>({rng.randint(1, 8)})")
+        elif r < 0.095:
+            out.append(f"&lt;https://www.example.org/{w}/&gt;")
+        elif r < 0.097:
+            out.append(f"<b>https://example.com/{w}</b>")
+        elif r < 0.10:
+            out.append("&nbsp;")
+        else:
+            out.append(w)
+    return " ".join(out)
+
+
+def page(rng: random.Random, sections: int, paragraphs: int = 20) -> str:
+    h = ['<table class="head">\n  <tr>\n    <td class="head-ltitle">PAGE(1)</td>\n    <td class="head-vol">General Commands Manual</td>\n'
+        '    <td class="head-rtitle">PAGE(1)</td>\n  </tr>\n</table>\n<div class="manual-text">']
+    for _ in range(sections):
+        title = " ".join(rng.choices(WORDS, k=rng.randint(1, 3))).upper()
+        h.append(f'<section class="Sh">\n<h1 class="Sh" id="{title.replace(" ", "_")}"><a class="permalink" href="#{title.replace(" ", "_")}">{title}</a></h1>')
+        for _ in range(paragraphs):
+            r = rng.random()
+            if r < 0.5:
+                h.append(f'<p class="Pp">{text(rng, 60)}</p>')
+            elif r < 0.7:
+                h.append('<dl class="Bl-tag">')
+                for _ in range(4):
+                    w = rng.choice(WORDS)
+                    h.append(f'  <dt id="{w}"><a class="permalink" href="#{w}"><b>-{w}</b></a></dt>\n  <dd>{text(rng, 30)}</dd>')
+                h.append('</dl>')
+            elif r < 0.8:
+                h.append('<div class="Bd-indent">\n<pre>\n' + "\n".join("    " + text(rng, 8) for _ in range(5)) + '\n</pre>\n</div>\n<br/>')
+            elif r < 0.85:
+                t = " ".join(rng.choices(WORDS, k=2)).title()
+                h.append(f'<section class="Ss">\n<h2 class="Ss" id="{t.replace(" ", "_")}"><a class="permalink" href="#{t.replace(" ", "_")}">{t}</a></h2>\n'
+                    f'<p class="Pp">{text(rng, 40)}</p>\n</section>')
+            elif r < 0.9:
+                h.append('<p class="Pp"></p>\n<div class="Pp"></div>\n' + text(rng, 20) + "\n<br/>\n" + text(rng, 20))
+            else:
+                h.append(f'<pre>https://example.net/{rng.choice(WORDS)}</pre>')
+        h.append('</section>')
+    h.append('</div>\n<table class="foot">\n  <tr>\n    <td class="foot-date">2024-01-01</td>\n    <td class="foot-os">bench</td>\n  </tr>\n</table>\n')
+    return "\n".join(h)
+
+
+def chain(html: str) -> tuple:
+    html = util._postprocess_html_chain(html)
+    return html, util.extract_headings(html)
+
+
+def single_pass(html: str) -> tuple:
+    """
+    None for the pages left to the chain
+    """
+    try:
+        return util._postprocess_html(html)
+    except util._Fallback:
+        return None
+
+
+def measure(postprocess, pages: list) -> float:
+    start = time.perf_counter()
+    for html in pages:
+        postprocess(html)
+    return (time.perf_counter() - start) / len(pages) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--sections", type=int, default=30, help="sections per page, 30 is about the size of bash(1)")
+    parser.add_argument("--fuzz", type=int, default=20000, help="pages of random fragments")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    pages = [page(rng, args.sections) for _ in range(args.pages)]
+    fallbacks = 0
+    for i in range(args.fuzz):
+        html = "".join(rng.choices(FRAGMENTS, k=rng.randint(1, 30)))
+        result = single_pass(html)
+        if result is None:
+            fallbacks += 1
+            continue
+        assert result == chain(html), f"output differs on fuzz page {i}: {html!r}"
+    for i, html in enumerate(pages):
+        result = single_pass(html)
+        assert result is not None, f"page {i} left to the chain"
+        assert result == chain(html), f"output differs on page {i}"
+    print(f"same output on {args.pages} pages and {args.fuzz - fallbacks} fuzz pages ({fallbacks} left to the chain)")
+
+    print(f"{args.pages} pages, {sum(map(len, pages)) / len(pages) / 1024:.0f} KiB on average")
+    print(f"{'':<14}{'ms/page':>10}")
+    for name, postprocess in (("chain", chain), ("single pass", util._postprocess_html)):
+        print(f"{name:<14}{measure(postprocess, pages):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Latency of full-text queries against the arch_search index.
+
+    python -m bench.search [--pages 30000] [--words 600] [--queries 500]
+
+Pages are made of words drawn from a synthetic vocabulary with a Zipf-like
+distribution, so there are very common terms (thousands of matching pages)
+as well as rare ones. The database lives in a temporary directory.
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from indexer import search
+from indexer.indexer import Indexer
+
+VOCABULARY = 20000
+
+
+def populate(db: str, pages: int, words: int):
+    indexer = Indexer("core", db)
+    con = indexer._con
+    rng = random.Random(0)
+    vocabulary = [f"w{i}" for i in range(VOCABULARY)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(VOCABULARY)))
+
+    rows = []
+    for i in range(pages):
+        section = str(rng.randint(1, 8))
+        text = " ".join(rng.choices(vocabulary, cum_weights=weights, k=words))
+        rows.append(dict(ID=i, NAME=f"page{i}", SECTION=section, LOCALE="en", DESCRIPTION=" ".join(rng.choices(vocabulary, cum_weights=weights, k=8)),
+            HEADINGS='[{"id": "NAME", "title": "NAME"}, {"id": "DESCRIPTION", "title": "DESCRIPTION"}]', TXT=text))
+    con.executemany("""INSERT INTO arch_manpages (ID, PACKAGE, REPO, FILENAME, NAME, SECTION, LOCALE, HEADINGS, DESCRIPTION)
+    VALUES (:ID, 'pkg', 'core', 'usr/share/man/man' || :SECTION || '/' || :NAME || '.' || :SECTION, :NAME, :SECTION, :LOCALE, :HEADINGS, :DESCRIPTION)""", rows)
+    search.index_pages(indexer._db, rows)
+    search.optimize(indexer._db)
+    con.commit()
+    return indexer
+
+
+def queries(count: int) -> dict:
+    rng = random.Random(1)
+    return {
+        "common word": [f"w{rng.randint(0, 10)}" for _ in range(count)],
+        "rare word": [f"w{rng.randint(5000, VOCABULARY - 1)}" for _ in range(count)],
+        "two words": [f"w{rng.randint(0, 100)} w{rng.randint(100, 2000)}" for _ in range(count)],
+        "prefix": [f"w{rng.randint(10, 99)}" for _ in range(count)],
+        "name": [f"page{rng.randint(0, 999)}" for _ in range(count)],
+        "no match": [f"missing{i}" for i in range(count)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=30000)
+    parser.add_argument("--words", type=int, default=600, help="words per page")
+    parser.add_argument("--queries", type=int, default=500, help="queries per kind")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        indexer = populate(os.path.join(tmp, "packages.db"), args.pages, args.words)
+        print(f"indexed {args.pages} pages in {time.perf_counter() - start:.1f} s")
+        # all pages are in the "en" locale, whose token must not match as a word
+        assert not search.search(indexer._db, "en"), "the locale matches as a word"
+        assert not search.search(indexer._db, "en", locale="en"), "the locale matches as a word"
+
+        print(f"{'query':<20}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        for kind, texts in queries(args.queries).items():
+            timings = []
+            for text in texts:
+                start = time.perf_counter()
+                search.search(indexer._db, text, locale="en")
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            print(f"{kind:<20}{statistics.mean(timings):>10.3f}{statistics.median(timings):>10.3f}{timings[int(len(timings) * 0.95)]:>10.3f}")
+        indexer._con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Decoding of man page sources
+
+Nearly all pages are ASCII or UTF-8 and are decoded without any guessing.
+The others are decoded with the charset named by a coding tag on one of
+their first two lines (.\\" -*- coding: koi8-r -*-, as read by preconv(1)),
+or by the locale directory they are installed in (ru.KOI8-R). Only if
+neither applies, chardet guesses the charset from a bounded sample around
+the first non-ASCII byte, and ISO-8859-1 is the last resort (it was the
+charset of every page that isn't UTF-8 before).
+
+The number of pages decoded by each of these paths is counted, for the
+summary of a run.
+"""
+import codecs
+import re
+import threading
+
+from collections import Counter
+from typing import Union
+
+import chardet
+
+DETECT_BYTES = 16 * 1024 # sample given to chardet
+MIN_CONFIDENCE = 0.3 # of chardet, below it the page is taken as ISO-8859-1
+PATHS = ("ascii", "utf-8", "hint", "locale", "detected", "fallback")
+
+_CODING_TAG = re.compile(rb"-\*-.*?\bcoding:\s*([A-Za-z0-9_.:-]+)", re.IGNORECASE)
+_NON_ASCII = re.compile(rb"[\x80-\xff]")
+
+
+def _codec(name: str) -> Union[None, str]:
+    """
+    Python name of the charset `name`, None if it's unknown
+    """
+    # emacs end-of-line variants, e.g. utf-8-unix
+    name = re.sub(r"-(unix|dos|mac)$", "", name, flags=re.IGNORECASE)
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+def coding_hint(data: bytes) -> Union[None, str]:
+    """
+    Charset of the coding tag on the first two lines of a roff source
+    """
+    for line in data.split(b"\n", 2)[:2]:
+        match = _CODING_TAG.search(line)
+        if match:
+            return _codec(match.group(1).decode("ascii"))
+    return None
+
+def locale_charset(lang: Union[None, str]) -> Union[None, str]:
+    """
+    Charset of a locale directory like ru.KOI8-R or sr.UTF-8@latin
+    """
+    if not lang or "." not in lang:
+        return None
+    return _codec(lang.split("@", 1)[0].split(".", 1)[1])
+
+
+class Decoder(object):
+    """
+    Decodes man page sources, safe to use from several threads
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    def _count(self, path: str):
+        with self._lock:
+            self.stats[path] += 1
+
+    def _strict(self, data: bytes, charset: Union[None, str]) -> Union[None, str]:
+        if charset is None:
+            return None
+        try:
+            return data.decode(charset)
+        except UnicodeDecodeError:
+            return None
+
+    def decode(self, data: bytes, lang: Union[None, str] = None) -> str:
+        """
+        lang: locale directory of the page, e.g. ru.KOI8-R
+        """
+        if data.isascii():
+            self._count("ascii")
+            return data.decode("ascii")
+        text = self._strict(data, "utf-8")
+        if text is not None:
+            self._count("utf-8")
+            return text
+        text = self._strict(data, coding_hint(data))
+        if text is not None:
+            self._count("hint")
+            return text
+        text = self._strict(data, locale_charset(lang))
+        if text is not None:
+            self._count("locale")
+            return text
+
+        start = _NON_ASCII.search(data).start()
+        detected = chardet.detect(data[max(0, start - 64):start + DETECT_BYTES])
+        charset = _codec(detected["encoding"] or "")
+        if charset is not None and detected["confidence"] >= MIN_CONFIDENCE:
+            self._count("detected")
+            return data.decode(charset, errors="replace")
+        self._count("fallback")
+        return data.decode("iso-8859-1")
+
+    def summary(self) -> str:
+        return ", ".join(f"{self.stats[path]} {path}" for path in PATHS)
@@ -5,30 +5,55 @@ import asyncio
 import sqlite3
 import json
 
-import chardet
-
-from packaging import version
 from pathlib import PurePath
 
 from typing import Union
 
 import re
-import xtarfile as tarfile # tarfile doesn't support zstd
+import tarfile # read as a stream, zstd is decompressed by zstandard
+import zstandard
 import gzip
+import io
 import os
+import sys
+import tempfile
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import datetime
+import email.utils
 import time
 
 from tqdm import tqdm
 
 import logging
-from .util import CustomFormatter, mandoc_convert, extract_headings, extract_description, resolve_so_links
+from . import search, storage
+from .charset import Decoder
+from .mirrors import MirrorPool, read_mirrorlist
+from .pkgcache import PackageCache
+from .rendercache import RenderCache, pack, unpack
+from .util import POSTPROCESS_VERSION, CustomFormatter, content_hash, mandoc_version, render_manpage, resolve_so_links, run_mandoc, so_target, split_sections
 
 
 arch = 'x86_64'
 tmpdir = 'temp/' # trailing slash
 MANDIR = 'usr/share/man'
+MIRROR = "https://mirrors.edge.kernel.org/archlinux/$repo/os/$arch" # mirrorlist syntax
+MIRRORLIST = None # path of a pacman mirrorlist, MIRROR is used if None
+
+REPOS = ["core"] # indexed by default, e.g. ["core", "extra", "multilib"]
+
+MAX_DOWNLOADS = 8 # packages downloaded concurrently
+MAX_DOWNLOADS_PER_HOST = 4
+RENDER_WORKERS = os.cpu_count() or 1 # mandoc worker processes
+STREAM_PACKAGES = True # extract packages while they download instead of reading them back from temp/pkgs
+PACKAGE_CACHE_BYTES = 4 * 2**30 # downloaded packages kept in temp/pkgs, least recently used are evicted
+RENDER_CACHE = tmpdir + 'render_cache.db' # renderings reused across pages, packages and runs
+WRITE_BATCH_SIZE = 1000 # pages written per transaction
+COMPRESS_CONTENTS = True # gzip page contents in the database
+CHUNKED_PAGE_BYTES = 512 * 1024 # html of pages larger than this is also stored in chunks, which the web app streams
+HTML_CHUNK_BYTES = 64 * 1024 # chunks are cut at sections and are at least this large
 
 # LOGGER
 logger = logging.getLogger("Indexer")
@@ -46,40 +71,165 @@ headers = {
 class UnknownManPath(Exception):
     pass
 
+class _ResponseReader(io.RawIOBase):
+    """
+    Blocking reader over an aiohttp response body, to be used from a worker thread
+    """
+    def __init__(self, content: aiohttp.StreamReader, loop: asyncio.AbstractEventLoop):
+        self._content = content
+        self._loop = loop
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = asyncio.run_coroutine_threadsafe(self._content.read(len(b)), self._loop).result()
+        b[:len(data)] = data
+        return len(data)
+
+class _TeeReader(io.RawIOBase):
+    """
+    Copies everything read from `raw` to `sink`
+    """
+    def __init__(self, raw: io.RawIOBase, sink):
+        self._raw = raw
+        self._sink = sink
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._raw.readinto(b)
+        self._sink.write(bytes(memoryview(b)[:n]))
+        return n
+
+def _html_chunks(html_content: str) -> list:
+    """
+    Sections of a large page, [] if the page is served in one piece
+    """
+    if len(html_content) <= CHUNKED_PAGE_BYTES:
+        return []
+    chunks = split_sections(html_content, HTML_CHUNK_BYTES)
+    return chunks if len(chunks) > 1 else []
+
+def _render_and_encode(content: str, encoding: Union[None, str], cached: Union[None, tuple] = None) -> dict:
+    """
+    Runs in the render pool, so compression doesn't happen on the event loop
+
+    cached: (POSTPROCESS, RAW, RENDERED) entry of the render cache, the
+    returned RENDER_CACHE is (RAW, POSTPROCESS, RENDERED) to store in it, or
+    None if the entry is up to date
+    """
+    render_cache = None
+    rendered = unpack(cached[2]) if cached is not None and cached[0] == POSTPROCESS_VERSION else None
+    raw = unpack(cached[1]) if cached is not None and rendered is None else None
+    if rendered is not None and rendered[0] and rendered[1]:
+        html_content, txt_content, headings, description = rendered
+    else:
+        if raw is not None and raw[0] and raw[1]:
+            raw_blob = None
+        else:
+            # empty output of mandoc isn't cached, earlier runs did cache the output of failed conversions
+            raw = run_mandoc(content, "html"), run_mandoc(content, "txt")
+            raw_blob = pack(*raw)
+        html_content, txt_content, headings, description = render_manpage(content, raw)
+        if raw[0] and raw[1]:
+            render_cache = (raw_blob, POSTPROCESS_VERSION, pack(html_content, txt_content, headings, description))
+    return {
+        "CONTENT": storage.encode(content, encoding),
+        "HTML_CONTENT": storage.encode(html_content, encoding),
+        "TXT_CONTENT": storage.encode(txt_content, encoding),
+        "HTML_ZSTD": storage.encode_zstd(html_content, encoding),
+        "TXT_ZSTD": storage.encode_zstd(txt_content, encoding),
+        "HTML_CHUNKS": storage.encode_chunks(_html_chunks(html_content), encoding),
+        "HEADINGS": headings,
+        "DESCRIPTION": description,
+        "TXT": txt_content, # plain text for the search index
+        "SO_TARGET": so_target(content),
+        "RENDER_CACHE": render_cache,
+    }
+
+def _open_tar_stream(fileobj, filename: str):
+    """
+    Open a package archive for reading in stream mode (no seeking)
+    """
+    if filename.endswith(".zst"):
+        return tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(fileobj), mode="r|")
+    return tarfile.open(fileobj=fileobj, mode="r|*")
+
 class Indexer(object):
 
-    def __init__(self, repo: str, db: str):
+    def __init__(self, repos: Union[str, list], db: str, max_downloads: int = MAX_DOWNLOADS, max_downloads_per_host: int = MAX_DOWNLOADS_PER_HOST, render_workers: int = RENDER_WORKERS, stream_packages: bool = STREAM_PACKAGES, compress_contents: bool = COMPRESS_CONTENTS, mirrorlist: Union[None, str] = MIRRORLIST, package_cache_bytes: int = PACKAGE_CACHE_BYTES, render_cache: str = RENDER_CACHE):
         self.INDEXER_STARTTIME = int(time.time())
-        self._repo = repo
+        self._repos = [repos] if isinstance(repos, str) else list(repos)
+        self._max_downloads = max_downloads
+        self._max_downloads_per_host = max_downloads_per_host
+        self._render_workers = render_workers
+        self._stream_packages = stream_packages
+        self._encoding = "gzip" if compress_contents else None
+        self._mirrorlist = mirrorlist
+        self._render_cache_path = render_cache
         self._con = sqlite3.connect(db) #isolation_level=None for autocommit
         self._con.row_factory = sqlite3.Row
         self._db = self._con.cursor()
         logger.info(f"Connected to db: {db}")
         self._init_db()
-        # create temp dir
-        if not os.path.exists(tmpdir + "pkgs"):
-            os.makedirs(tmpdir + "pkgs")
-
-    def _decode(self, text):
-        CHARSETS = ["utf-8", "ascii", "iso-8859-1", "iso-8859-9", "iso-8859-15", "cp1250", "cp1252"]
-
-        for charset in CHARSETS:
-            try:
-                return text.decode(charset)
-            except UnicodeDecodeError:
-                pass
-            except LookupError:
-                # ignore invalid encoding_hint
-                pass
-
-        # fall back to chardet and errors="replace"
-        encoding = chardet.detect(text)["encoding"]
-        return text.decode(encoding, errors="replace")
-
+        self._pkgcache = PackageCache(tmpdir + "pkgs", package_cache_bytes)
+        self._decoder = Decoder()
 
     def _init_db(self):
+        self._create_package_table()
+        self._create_manpage_tables()
+        self._db.execute("""CREATE TABLE IF NOT EXISTS arch_meta (
+            ID INTEGER NOT NULL PRIMARY KEY,
+            TIMESTAMP INTEGER,
+            HAVEMAN_PKGS INTEGER,
+            TOTAL_PKGS INTEGER,
+            ETAG TEXT,
+            REPO TEXT
+        );
+        """)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS arch_executions (
+            START_TIME INTEGER,
+            EXECUTION_TIME INTEGER,
+            UPDATED_PKGS INTEGER,
+            UPDATED_PAGES INTEGER
+        );
+        """)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS arch_redirects (
+            SOURCE_NAME TEXT,
+            SOURCE_SECTION TEXT,
+            SOURCE_LANG TEXT,
+            TARGET_NAME TEXT,
+            TARGET_SECTION TEXT,
+            TARGET_LANG TEXT,
+            UPDATED_AT INTEGER DEFAULT 0
+        );
+        """)
+        # progress of the packages being updated, a package is only written to
+        # arch_packages (at its new version) once all its pages are committed;
+        # an unfinished job is redone from the start, its download comes back
+        # from the package cache and its unchanged pages are skipped by hash
+        self._db.execute("""CREATE TABLE IF NOT EXISTS arch_jobs (
+            REPO TEXT,
+            NAME TEXT,
+            FINGERPRINT TEXT,
+            STATE TEXT, -- pending or committed
+            PACKAGE TEXT, -- JSON, as queued by _get_file_index
+            UPDATED_AT INTEGER,
+            PRIMARY KEY (REPO, NAME)
+        );
+        """)
+        self._migrate_db()
+        # one row per repo
+        self._db.executemany("""INSERT OR IGNORE INTO arch_meta (REPO, TIMESTAMP)
+        VALUES(?, 0);
+        """, ((repo,) for repo in self._repos))
+        self._con.commit()
+
+    def _create_package_table(self):
         self._db.execute("""CREATE TABLE IF NOT EXISTS arch_packages (
-            NAME TEXT UNIQUE PRIMARY KEY,
+            NAME TEXT,
             REPO TEXT,
             VERSION TEXT,
             FILENAME TEXT,
@@ -87,87 +237,281 @@ class Indexer(object):
             UPSTREAM TEXT,
             LICENSE TEXT,
             URL TEXT,
-            MANPATHS TEXT
+            MANPATHS TEXT,
+            FINGERPRINT TEXT,
+            PRIMARY KEY (REPO, NAME)
         );
         """)
+
+    def _create_manpage_tables(self):
         self._db.execute("""CREATE TABLE IF NOT EXISTS arch_manpages (
+            ID INTEGER PRIMARY KEY,
             PACKAGE TEXT,
             REPO TEXT,
-            FILENAME TEXT UNIQUE PRIMARY KEY,
+            FILENAME TEXT,
             NAME TEXT,
             SECTION TEXT,
             LOCALE TEXT,
             HEADINGS TEXT,
             DESCRIPTION TEXT,
-            CONTENT TEXT,
-            HTML_CONTENT TEXT,
-            TXT_CONTENT TEXT,
-            SO_RESOLVED INTEGER DEFAULT 0
+            SO_RESOLVED INTEGER DEFAULT 0,
+            CONTENT_HASH TEXT,
+            UPDATED_AT INTEGER DEFAULT 0, -- START_TIME of the execution that last wrote the page
+            UNIQUE (REPO, FILENAME) -- the same path can be shipped by several repos
         );
         """)
-        self._db.execute("""CREATE TABLE IF NOT EXISTS arch_meta (
-            ID INTEGER NOT NULL PRIMARY KEY,
-            TIMESTAMP INTEGER,
-            HAVEMAN_PKGS INTEGER,
-            TOTAL_PKGS INTEGER
+        # the big blobs are kept out of arch_manpages so that metadata queries stay cheap
+        self._db.execute("""CREATE TABLE IF NOT EXISTS arch_contents (
+            ID INTEGER PRIMARY KEY, -- arch_manpages.ID
+            ENCODING TEXT, -- NULL or "gzip", see storage.py
+            CONTENT BLOB,
+            HTML_CONTENT BLOB,
+            TXT_CONTENT BLOB,
+            HTML_ZSTD BLOB,
+            TXT_ZSTD BLOB
         );
         """)
-        self._db.execute("""CREATE TABLE IF NOT EXISTS arch_executions (
-            START_TIME INTEGER,
-            EXECUTION_TIME INTEGER,
-            UPDATED_PKGS INTEGER,
-            UPDATED_PAGES INTEGER
-        );
-        """)
-        self._db.execute("""CREATE TABLE IF NOT EXISTS arch_redirects (
-            SOURCE_NAME TEXT,
-            SOURCE_SECTION TEXT,
-            SOURCE_LANG TEXT,
+
+    def _add_column(self, table: str, column: str, definition: str) -> bool:
+        """
+        Add `column` to `table` unless it's already there, returns True if added
+        """
+        self._db.execute(f"PRAGMA table_info({table})")
+        if column in (row['name'] for row in self._db.fetchall()):
+            return False
+        self._db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        logger.info(f"Added column {table}.{column}")
+        return True
+
+    def _unique_columns(self, table: str) -> list:
+        """
+        Columns of each UNIQUE constraint of `table`, as tuples
+        """
+        self._db.execute(f"PRAGMA index_list({table})")
+        indexes = [row['name'] for row in self._db.fetchall() if row['unique'] and row['origin'] == 'u']
+        columns = []
+        for index in indexes:
+            self._db.execute(f"PRAGMA index_info({index})")
+            columns.append(tuple(row['name'] for row in self._db.fetchall()))
+        return columns
+
+    def _migrate_db(self):
+        """
+        Bring databases created by older versions up to date
+        """
+        if self._add_column("arch_packages", "FINGERPRINT", "TEXT"):
+            self._db.execute("""UPDATE arch_packages
+            SET FINGERPRINT = NAME || ' ' || VERSION || ' ' || FILENAME""")
+        self._add_column("arch_meta", "ETAG", "TEXT")
+        if self._add_column("arch_meta", "REPO", "TEXT"):
+            # databases used to hold core only, in the row with ID 1
+            self._db.execute("""UPDATE arch_meta SET REPO = 'core' WHERE ID = 1""")
+        self._db.execute("""CREATE UNIQUE INDEX IF NOT EXISTS arch_meta_repo ON arch_meta (REPO)""")
+        self._db.execute("""PRAGMA table_info(arch_packages)""")
+        if {row['name']: row['pk'] for row in self._db.fetchall()}.get('REPO') == 0:
+            self._rekey_packages()
+        if self._add_column("arch_manpages", "CONTENT_HASH", "TEXT"):
+            self._db.execute("""SELECT FILENAME, CONTENT FROM arch_manpages""")
+            hashes = [(content_hash(row['CONTENT']), row['FILENAME']) for row in self._db.fetchall()]
+            self._db.executemany("""UPDATE arch_manpages SET CONTENT_HASH = ? WHERE FILENAME = ?""", hashes)
+        self._db.execute("""PRAGMA table_info(arch_manpages)""")
+        split = 'CONTENT' in (row['name'] for row in self._db.fetchall())
+        if split:
+            self._split_contents()
+        self._add_column("arch_contents", "HTML_ZSTD", "BLOB")
+        if self._add_column("arch_contents", "TXT_ZSTD", "BLOB") or split:
+            self._reencode_contents()
+
+        self._add_column("arch_manpages", "UPDATED_AT", "INTEGER DEFAULT 0")
+        self._add_column("arch_redirects", "UPDATED_AT", "INTEGER DEFAULT 0")
+        self._db.execute("""SELECT 1 FROM sqlite_master WHERE name = 'arch_search'""")
+        if self._db.fetchone() is None:
+            search.create_table(self._db)
+            self._index_contents()
+        self._db.execute("""SELECT 1 FROM sqlite_master WHERE name = 'arch_so_links'""")
+        if self._db.fetchone() is None:
+            self._create_so_links_table()
+        self._db.execute("""SELECT 1 FROM sqlite_master WHERE name = 'arch_html_chunks'""")
+        if self._db.fetchone() is None:
+            self._create_html_chunks_table()
+        analyze = ("FILENAME",) in self._unique_columns("arch_manpages")
+        if analyze:
+            self._rekey_manpages() # the statistics of the old table are gone
+
+        # lookups done by the web app and by the indexer itself
+        self._db.execute("""CREATE INDEX IF NOT EXISTS arch_manpages_name_section_locale ON arch_manpages (NAME, SECTION, LOCALE)""")
+        self._db.execute("""CREATE INDEX IF NOT EXISTS arch_manpages_locale ON arch_manpages (LOCALE)""")
+        self._db.execute("""CREATE INDEX IF NOT EXISTS arch_manpages_package ON arch_manpages (PACKAGE)""")
+        # keyset order of the repo and section listings
+        self._db.execute("""CREATE INDEX IF NOT EXISTS arch_manpages_repo_name_section_locale ON arch_manpages (REPO, NAME, SECTION, LOCALE)""")
+        self._db.execute("""CREATE INDEX IF NOT EXISTS arch_manpages_section_name_locale ON arch_manpages (SECTION, NAME, LOCALE)""")
+        self._db.execute("""SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'arch_redirects_source'""")
+        if self._db.fetchone() is None:
+            # older runs inserted the same redirects over and over, keep the latest
+            self._db.execute("""DELETE FROM arch_redirects WHERE rowid NOT IN (
+                SELECT MAX(rowid) FROM arch_redirects GROUP BY SOURCE_NAME, SOURCE_SECTION, SOURCE_LANG
+            )""")
+            self._db.execute("""CREATE UNIQUE INDEX arch_redirects_source ON arch_redirects (SOURCE_NAME, SOURCE_SECTION, SOURCE_LANG)""")
+            logger.info("Created index arch_redirects_source")
+            analyze = True
+        if analyze:
+            # without statistics the planner happily uses the LOCALE index for NAME = ? AND LOCALE = ?
+            self._db.execute("ANALYZE")
+
+    def _rekey_packages(self):
+        """
+        Key arch_packages by (REPO, NAME) instead of NAME, the same name can
+        be in several repos
+        """
+        logger.info("Keying arch_packages by (REPO, NAME)")
+        self._db.execute("""ALTER TABLE arch_packages RENAME TO arch_packages_old""")
+        self._create_package_table()
+        self._db.execute("""INSERT INTO arch_packages (NAME, REPO, VERSION, FILENAME, ARCH, UPSTREAM, LICENSE, URL, MANPATHS, FINGERPRINT)
+        SELECT NAME, REPO, VERSION, FILENAME, ARCH, UPSTREAM, LICENSE, URL, MANPATHS, FINGERPRINT FROM arch_packages_old""")
+        self._db.execute("""DROP TABLE arch_packages_old""")
+
+    def _rekey_manpages(self):
+        """
+        Key arch_manpages by (REPO, FILENAME) instead of FILENAME, the IDs
+        the other tables refer to are kept
+        """
+        logger.info("Keying arch_manpages by (REPO, FILENAME)")
+        self._db.execute("""ALTER TABLE arch_manpages RENAME TO arch_manpages_old""")
+        self._create_manpage_tables()
+        self._db.execute("""INSERT INTO arch_manpages (ID, PACKAGE, REPO, FILENAME, NAME, SECTION, LOCALE, HEADINGS, DESCRIPTION, SO_RESOLVED, CONTENT_HASH, UPDATED_AT)
+        SELECT ID, PACKAGE, REPO, FILENAME, NAME, SECTION, LOCALE, HEADINGS, DESCRIPTION, SO_RESOLVED, CONTENT_HASH, UPDATED_AT FROM arch_manpages_old""")
+        self._db.execute("""DROP TABLE arch_manpages_old""") # takes its indexes along
+
+    def _split_contents(self):
+        """
+        Move the contents out of an old-style arch_manpages table into arch_contents
+        """
+        logger.info("Moving page contents to arch_contents, this may take a while")
+        self._db.execute("""ALTER TABLE arch_manpages RENAME TO arch_manpages_old""")
+        self._create_manpage_tables()
+        self._db.execute("""INSERT INTO arch_manpages (ID, PACKAGE, REPO, FILENAME, NAME, SECTION, LOCALE, HEADINGS, DESCRIPTION, SO_RESOLVED, CONTENT_HASH)
+        SELECT rowid, PACKAGE, REPO, FILENAME, NAME, SECTION, LOCALE, HEADINGS, DESCRIPTION, SO_RESOLVED, CONTENT_HASH FROM arch_manpages_old""")
+        self._db.execute("""INSERT INTO arch_contents (ID, ENCODING, CONTENT, HTML_CONTENT, TXT_CONTENT)
+        SELECT rowid, NULL, CONTENT, HTML_CONTENT, TXT_CONTENT FROM arch_manpages_old""")
+        self._db.execute("""DROP TABLE arch_manpages_old""") # takes its indexes along
+
+    def _reencode_contents(self):
+        """
+        Store all contents with the current encoding (and their zstd variants)
+        """
+        logger.info(f"Re-encoding page contents as {self._encoding}, this may take a while")
+        self._db.execute("""SELECT ID FROM arch_contents""")
+        ids = [row['ID'] for row in self._db.fetchall()]
+        for page_id in ids:
+            self._db.execute("""SELECT * FROM arch_contents WHERE ID = ?""", (page_id,))
+            row = self._db.fetchone()
+            content, html_content, txt_content = (storage.decode(row[column], row['ENCODING']) for column in ('CONTENT', 'HTML_CONTENT', 'TXT_CONTENT'))
+            self._db.execute("""UPDATE arch_contents
+            SET ENCODING = ?, CONTENT = ?, HTML_CONTENT = ?, TXT_CONTENT = ?, HTML_ZSTD = ?, TXT_ZSTD = ?
+            WHERE ID = ?""", (self._encoding, storage.encode(content, self._encoding), storage.encode(html_content, self._encoding), storage.encode(txt_content, self._encoding),
+                storage.encode_zstd(html_content, self._encoding), storage.encode_zstd(txt_content, self._encoding), page_id,))
+        self._con.commit()
+        self._db.execute("VACUUM")
+
+    def _create_so_links_table(self):
+        """
+        Create arch_so_links and fill it from the existing pages
+        """
+        # pages made of a single .so request, resolve_so_links copies the target's contents into them
+        self._db.execute("""CREATE TABLE arch_so_links (
+            SOURCE_ID INTEGER PRIMARY KEY, -- arch_manpages.ID
             TARGET_NAME TEXT,
             TARGET_SECTION TEXT,
-            TARGET_LANG TEXT
+            TARGET_HASH TEXT -- CONTENT_HASH of the target when the link was last resolved
         );
         """)
-        self._db.execute("""SELECT * from arch_meta limit 1""")
-        if self._db.fetchone() is None:
-            # empty table
-            self._db.execute("""INSERT INTO arch_meta (ID, TIMESTAMP)
-            VALUES(1, 0);
-            """)
+        links = []
+        for row in self._con.execute("""SELECT ID, ENCODING, CONTENT FROM arch_contents"""):
+            target = so_target(storage.decode(row['CONTENT'], row['ENCODING']))
+            if target is not None:
+                links.append((row['ID'],) + target)
+        self._db.executemany("""INSERT INTO arch_so_links (SOURCE_ID, TARGET_NAME, TARGET_SECTION) VALUES (?, ?, ?)""", links)
+        logger.info(f"Created arch_so_links with {len(links)} links")
+
+    def _create_html_chunks_table(self):
+        """
+        Create arch_html_chunks and fill it from the existing pages
+        """
+        # the html of large pages cut at its sections, see _html_chunks
+        self._db.execute("""CREATE TABLE arch_html_chunks (
+            ID INTEGER, -- arch_manpages.ID
+            SEQ INTEGER,
+            HTML_CONTENT BLOB, -- with the ENCODING of the page in arch_contents
+            HTML_ZSTD BLOB,
+            PRIMARY KEY (ID, SEQ)
+        );
+        """)
+        chunked = 0
+        for row in self._con.execute("""SELECT ID, ENCODING, HTML_CONTENT FROM arch_contents"""):
+            chunks = storage.encode_chunks(_html_chunks(storage.decode(row['HTML_CONTENT'], row['ENCODING']) or ""), row['ENCODING'])
+            self._db.executemany("""INSERT INTO arch_html_chunks (ID, SEQ, HTML_CONTENT, HTML_ZSTD) VALUES (?, ?, ?, ?)""",
+                ((row['ID'], seq) + chunk for seq, chunk in enumerate(chunks)))
+            chunked += bool(chunks)
+        logger.info(f"Created arch_html_chunks with {chunked} chunked pages")
+
+    def _index_contents(self):
+        """
+        Add all existing pages to the search index
+        """
+        self._db.execute("""SELECT ID FROM arch_manpages""")
+        ids = [row['ID'] for row in self._db.fetchall()]
+        if not ids:
+            return
+        logger.info("Building the search index, this may take a while")
+        for start in range(0, len(ids), WRITE_BATCH_SIZE):
+            batch = ids[start:start + WRITE_BATCH_SIZE]
+            self._db.execute(f"""SELECT m.ID, m.NAME, m.LOCALE, m.DESCRIPTION, m.HEADINGS, c.ENCODING, c.TXT_CONTENT FROM arch_manpages m
+            JOIN arch_contents c ON c.ID = m.ID
+            WHERE m.ID IN ({", ".join("?" * len(batch))})""", batch)
+            search.index_pages(self._db, (dict(row, TXT=storage.decode(row['TXT_CONTENT'], row['ENCODING'])) for row in self._db.fetchall()))
+        search.optimize(self._db)
         self._con.commit()
 
     async def __aenter__(self):
-        self._session = aiohttp.ClientSession(raise_for_status=True, headers=headers) # make sure all requests are 200
-        self._mirror = await self._get_mirror()
+        connector = aiohttp.TCPConnector(limit=self._max_downloads, limit_per_host=self._max_downloads_per_host)
+        # no total timeout, big packages take a while, but a stalled mirror fails the download
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        self._session = aiohttp.ClientSession(connector=connector, raise_for_status=True, headers=headers, timeout=timeout) # make sure all requests are 200
+        self._render_pool = ProcessPoolExecutor(max_workers=self._render_workers, mp_context=multiprocessing.get_context("forkserver"))
+        self._render_cache = RenderCache(self._render_cache_path, mandoc_version())
+        self._mirrors = await self._get_mirrors()
         return self
 
     async def __aexit__(self, *err):
         await self._session.close()
+        self._render_pool.shutdown(cancel_futures=True)
+        self._render_cache.close()
         self._con.close() # close sqlite3 db
 
-    def _get_manpage(self, filename: str) -> Union[None, str]:
+    def _get_manpage(self, repo: str, filename: str) -> Union[None, str]:
         """
         Fetch content of manpage from database
         """
         self._db.execute("""SELECT * FROM arch_manpages
-        WHERE FILENAME = ?;""", (filename,))
+        WHERE REPO = ? AND FILENAME = ?;""", (repo, filename,))
         result = self._db.fetchone()
         if result is None:
             return None
         else:
             return result
 
-    def _get_manpage_html(self, filename: str) -> Union[None, str]:
+    def _get_manpage_html(self, repo: str, filename: str) -> Union[None, str]:
         """
         Fetch compiled html of manpage from database
         """
-        self._db.execute("""SELECT HTML_CONTENT FROM arch_manpages
-        WHERE FILENAME = ?;""", (filename,))
+        self._db.execute("""SELECT c.ENCODING, c.HTML_CONTENT FROM arch_contents c
+        JOIN arch_manpages m ON m.ID = c.ID
+        WHERE m.REPO = ? AND m.FILENAME = ?;""", (repo, filename,))
         result = self._db.fetchone()
         if result is None:
             return None
         else:
-            return result['CONTENT']
+            return storage.decode(result['HTML_CONTENT'], result['ENCODING'])
 
     def _insert_execution(self):
         exec_time = self.INDEXER_ENDTIME - self.INDEXER_STARTTIME
@@ -176,38 +520,134 @@ class Indexer(object):
         self._con.commit()
 
 
-    def _insert_manpage(self, package, filename, headings, description, content, html_content, txt_content):
+    def _get_content_hashes(self, repo: str, package: str) -> dict:
         """
-        Make sure to commit() after running this
+        Fetch {FILENAME: CONTENT_HASH} of all pages of `package`
         """
+        self._db.execute("""SELECT FILENAME, CONTENT_HASH FROM arch_manpages
+        WHERE PACKAGE = ? AND REPO = ?;""", (package, repo,))
+        return dict(self._db.fetchall())
 
-        prevman = self._get_manpage(filename)
-        if prevman is None or content != self._get_manpage(filename)['CONTENT']:
-
-            try:
-                name, section, locale = self._getmanpathinfo(filename)
-            except UnknownManPath:
-                logger.warning("Skipping path with unrecognized structure: {}".format(path))
+    def _insert_manpage(self, repo: str, package: str, filename: str, page: dict):
+        """
+        Queue a page for writing, pages are flushed every WRITE_BATCH_SIZE pages
 
-            self._db.execute("""INSERT OR REPLACE INTO arch_manpages (PACKAGE, REPO, FILENAME, NAME, SECTION, LOCALE, HEADINGS, DESCRIPTION, CONTENT, HTML_CONTENT, TXT_CONTENT)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-            """, (package, self._repo, filename, name, section, locale, headings, description, content, html_content, txt_content,))
-            #self._con.commit()
-            logger.info(f"Updated {filename} for package {package}")
+        page: dict as returned by _render_and_encode, plus CONTENT_HASH
+        """
+        try:
+            name, section, locale = self._getmanpathinfo(filename)
+        except UnknownManPath:
+            logger.warning("Skipping path with unrecognized structure: {}".format(filename))
+            return
+
+        self._pending_pages.append(dict(page, PACKAGE=package, REPO=repo, FILENAME=filename, NAME=name, SECTION=section, LOCALE=locale, ENCODING=self._encoding, UPDATED_AT=self.INDEXER_STARTTIME))
+        logger.info(f"Updated {filename} for package {package}")
+        if len(self._pending_pages) >= WRITE_BATCH_SIZE:
+            self._flush_manpages()
+
+    def _flush_manpages(self):
+        """
+        Write the queued pages and redirects, and the packages whose pages are
+        all written, in a single transaction
+        """
+        # upsert keeps the ID of existing pages, arch_contents rows refer to it
+        self._db.executemany("""INSERT INTO arch_manpages (PACKAGE, REPO, FILENAME, NAME, SECTION, LOCALE, HEADINGS, DESCRIPTION, CONTENT_HASH, SO_RESOLVED, UPDATED_AT)
+        VALUES(:PACKAGE, :REPO, :FILENAME, :NAME, :SECTION, :LOCALE, :HEADINGS, :DESCRIPTION, :CONTENT_HASH, 0, :UPDATED_AT)
+        ON CONFLICT(REPO, FILENAME) DO UPDATE SET
+            PACKAGE = excluded.PACKAGE,
+            NAME = excluded.NAME,
+            SECTION = excluded.SECTION,
+            LOCALE = excluded.LOCALE,
+            HEADINGS = excluded.HEADINGS,
+            DESCRIPTION = excluded.DESCRIPTION,
+            CONTENT_HASH = excluded.CONTENT_HASH,
+            SO_RESOLVED = 0,
+            UPDATED_AT = excluded.UPDATED_AT;
+        """, self._pending_pages)
+        self._db.executemany("""INSERT OR REPLACE INTO arch_contents (ID, ENCODING, CONTENT, HTML_CONTENT, TXT_CONTENT, HTML_ZSTD, TXT_ZSTD)
+        VALUES((SELECT ID FROM arch_manpages WHERE REPO = :REPO AND FILENAME = :FILENAME), :ENCODING, :CONTENT, :HTML_CONTENT, :TXT_CONTENT, :HTML_ZSTD, :TXT_ZSTD);
+        """, self._pending_pages)
+        self._db.execute(f"""SELECT REPO, FILENAME, ID FROM arch_manpages
+        WHERE FILENAME IN ({", ".join("?" * len(self._pending_pages))})""", [page['FILENAME'] for page in self._pending_pages])
+        ids = {(row['REPO'], row['FILENAME']): row['ID'] for row in self._db.fetchall()}
+        # two packages of a repo can ship the same path, the upsert above keeps the last of their pages
+        pages = list({ids[page['REPO'], page['FILENAME']]: dict(page, ID=ids[page['REPO'], page['FILENAME']]) for page in self._pending_pages}.values())
+        self._db.executemany("""DELETE FROM arch_html_chunks WHERE ID = :ID""", pages)
+        self._db.executemany("""INSERT INTO arch_html_chunks (ID, SEQ, HTML_CONTENT, HTML_ZSTD) VALUES (?, ?, ?, ?)""",
+            ((page['ID'], seq) + chunk for page in pages for seq, chunk in enumerate(page['HTML_CHUNKS'])))
+        search.index_pages(self._db, pages)
+        # a rewritten page may have become, or stopped being, a .so link
+        self._db.executemany("""DELETE FROM arch_so_links WHERE SOURCE_ID = :ID""", pages)
+        self._db.executemany("""INSERT INTO arch_so_links (SOURCE_ID, TARGET_NAME, TARGET_SECTION) VALUES (?, ?, ?)""",
+            ((page['ID'],) + page['SO_TARGET'] for page in pages if page['SO_TARGET'] is not None))
+        self._insert_redirects(self._redirects)
+        self._commit_packages(self._rendered_pkgs)
+        self._con.commit()
+        self._render_cache.commit()
+        self._pending_pages = []
+        self._redirects = []
+        self._rendered_pkgs = []
 
     def _insert_redirects(self, redirects: list):
-        self._db.executemany("""INSERT INTO arch_redirects
-            VALUES (?, ?, ?, ?, ?, ?);
-        """, redirects)
-        self._con.commit()
+        self._db.executemany("""INSERT OR REPLACE INTO arch_redirects (SOURCE_NAME, SOURCE_SECTION, SOURCE_LANG, TARGET_NAME, TARGET_SECTION, TARGET_LANG, UPDATED_AT)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+        """, (redirect + (self.INDEXER_STARTTIME,) for redirect in redirects))
+
+    def _queue_jobs(self, repo: str, packages: list):
+        """
+        Replace the unfinished jobs of `repo` with `packages`, the files
+        database they come from is newer than the one of those jobs
+        """
+        self._db.execute("""DELETE FROM arch_jobs WHERE REPO = ? AND STATE != 'committed'""", (repo,))
+        self._db.executemany("""INSERT INTO arch_jobs (REPO, NAME, FINGERPRINT, STATE, PACKAGE, UPDATED_AT)
+        VALUES (?, ?, ?, 'pending', ?, ?)
+        ON CONFLICT(REPO, NAME) DO UPDATE SET
+            FINGERPRINT = excluded.FINGERPRINT,
+            STATE = 'pending',
+            PACKAGE = excluded.PACKAGE,
+            UPDATED_AT = excluded.UPDATED_AT;
+        """, ((repo, pkg['name'], pkg['fingerprint'], json.dumps(pkg), self.INDEXER_STARTTIME) for pkg in packages))
+
+    def _get_jobs(self, repo: str) -> list:
+        """
+        Packages of `repo` that still need updating, including the ones an
+        interrupted run didn't finish
+        """
+        self._db.execute("""SELECT PACKAGE FROM arch_jobs WHERE REPO = ? AND STATE != 'committed' ORDER BY NAME""", (repo,))
+        return [json.loads(row[0]) for row in self._db.fetchall()]
+
+    def _set_job_state(self, pkg: dict, state: str):
+        # not committed by itself, 'committed' is saved with the package's last pages
+        self._db.execute("""UPDATE arch_jobs SET STATE = ?, UPDATED_AT = ? WHERE REPO = ? AND NAME = ?""",
+            (state, self.INDEXER_STARTTIME, pkg['repo'], pkg['name']))
+
+    def _commit_packages(self, packages: list):
+        self._db.executemany("""INSERT INTO arch_packages (NAME, REPO, VERSION, FILENAME, ARCH, UPSTREAM, LICENSE, URL, MANPATHS, FINGERPRINT)
+        VALUES (:name, :repo, :version, :filename, :arch, :upstream, :license, :url, :manpaths, :fingerprint)
+        ON CONFLICT(REPO, NAME) DO UPDATE SET
+            VERSION = excluded.VERSION,
+            FILENAME = excluded.FILENAME,
+            ARCH = excluded.ARCH,
+            UPSTREAM = excluded.UPSTREAM,
+            LICENSE = excluded.LICENSE,
+            URL = excluded.URL,
+            MANPATHS = excluded.MANPATHS,
+            FINGERPRINT = excluded.FINGERPRINT;
+        """, (dict(pkg, manpaths=json.dumps(pkg['manpaths'])) for pkg in packages))
+        for pkg in packages:
+            self._set_job_state(pkg, 'committed')
+            if pkg['new']:
+                self._newpkgs += 1
+            else:
+                self._updatedpkgs += 1
 
 
-    def _update_meta(self, key: str, value: int):
+    def _update_meta(self, repo: str, key: str, value: Union[int, str]):
         self._db.execute(f"""UPDATE arch_meta
             SET {key} = ?
             WHERE
-                ID = 1;
-            """, (value,))
+                REPO = ?;
+            """, (value, repo,))
         self._con.commit()
 
     # return resp of url
@@ -216,33 +656,15 @@ class Indexer(object):
             response = await resp.text()
         return response
         
-    # download `url` to `file_name`
-    async def _download_file(self, url: str, file_name: str):
-        with open(file_name, mode='wb') as f:
-            async with self._session.get(url) as resp:
-                total_length = resp.headers.get('Content-Length')
-                if total_length is None: f.write(await resp.read())
-                else:
-                    dl = 0
-                    total_length = int(total_length)
-                    pbar = tqdm(total=total_length)
-                    async for chunk in resp.content.iter_chunked(8*1024*1024): # 8 MiB
-                        dl += len(chunk)
-                        pbar.update(len(chunk))
-                        f.write(chunk)
-                        #print(dl / total_length)
-                    pbar.close()
-                logger.info(f"Downloaded {file_name}")
-                return resp
-
-
-    async def _get_mirror(self) -> str:
-        #logger.info("Downloading Mirrorlist")
-        #mirrorlist = await self._fetch_file("https://archlinux.org/mirrorlist/?country=US&protocol=http&protocol=https&ip_version=4&use_mirror_status=on")
-        #mirror = re.findall(r'#Server = (http?s\:\/\/.*)', mirrorlist)[0].replace('$repo', self._repo).replace('$arch', arch)
-        #logger.info(f"Selected Mirror: {mirror}")
-        #return mirror
-        return "https://mirrors.edge.kernel.org/archlinux/core/os/x86_64"
+    async def _get_mirrors(self) -> MirrorPool:
+        if self._mirrorlist is None:
+            return MirrorPool([MIRROR], arch)
+        with open(self._mirrorlist) as f:
+            servers = read_mirrorlist(f.read())
+        logger.info(f"Read {len(servers)} mirrors from {self._mirrorlist}")
+        mirrors = MirrorPool(servers, arch)
+        await mirrors.probe(self._repos[0], headers)
+        return mirrors
 
     def _ismanpath(self, path: str) -> bool:
         if path.startswith(MANDIR) and not path.endswith("/"):
@@ -294,31 +716,35 @@ class Indexer(object):
         #}
         return man_name, man_section, man_lang
 
-    def _read_files(self, file: str) -> list: # read "files"
-        with open(file, "r") as f:
-            lines = f.readlines()
-
+    def _read_files(self, files: str) -> list: # read "files"
         manpaths = []
 
-        for line in lines:
+        if MANDIR not in files:
+            # most packages don't ship man pages
+            return manpaths
+
+        for line in files.splitlines():
             line = line.rstrip()
             if self._ismanpath(line):
                 manpaths.append(line)
 
         return manpaths
 
-    def _read_desc(self, file: str) -> dict:
-        with open(file, "r") as f:
-            desc = f.read()
-
+    def _read_desc(self, desc: str, file: str) -> dict:
         regex = r"\s*%([^%]+)%\s*\n\s*([^\n]+)\s*\n"
         meta = dict(re.findall(regex, desc))
         if 'FILENAME' not in meta or 'VERSION' not in meta or 'NAME' not in meta:
             logger.warn(f"Missing metadata from package: {file}")
         return meta
 
-    def _get_pkg(self, pkgname, field=None) -> Union[str, int, dict]:
-        self._db.execute(f"SELECT {field if field else '*'} FROM arch_packages WHERE NAME = ?", (pkgname,))
+    def _fingerprint(self, meta: dict) -> str:
+        """
+        Identifies a package build, same format as the FINGERPRINT column
+        """
+        return f"{meta.get('NAME')} {meta.get('VERSION')} {meta.get('FILENAME')}"
+
+    def _get_pkg(self, repo, pkgname, field=None) -> Union[str, int, dict]:
+        self._db.execute(f"SELECT {field if field else '*'} FROM arch_packages WHERE REPO = ? AND NAME = ?", (repo, pkgname,))
         entry = self._db.fetchone()
         if entry is None:
             return None
@@ -327,121 +753,132 @@ class Indexer(object):
         else:
             return(dict(entry))
 
-    async def _get_file_index(self):
-        logger.info(f"Downloading {self._repo}.files.tar.gz")
-
-        if os.path.exists(tmpdir + f"{self._repo}.files.tar.gz"):
-            logger.info(f"{self._repo}.files.tar.gz already exists, downloading to {self._repo}.files.tar.gz.new")
-            resp = await self._download_file("{}/{}.files.tar.gz".format(self._mirror, self._repo), tmpdir + f"{self._repo}.files.tar.gz.new")
+    def _parse_http_date(self, date: str) -> float:
+        timestamp = datetime.datetime.strptime(date, '%a, %d %b %Y %X GMT')
+        return timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
 
-            remote_timestamp = resp.headers['last-modified']
-            remote_timestamp = datetime.datetime.strptime(remote_timestamp, '%a, %d %b %Y %X GMT')
-            remote_timestamp = remote_timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
-
-            self._db.execute("""SELECT TIMESTAMP FROM arch_meta WHERE ID = 1;""")
-            local_timestamp = self._db.fetchone()['TIMESTAMP']
-
-            if remote_timestamp > local_timestamp:
-                logger.info(f"Replacing {self._repo}.files.tar.gz with {self._repo}.files.tar.gz.new")
-                os.replace(tmpdir + f"{self._repo}.files.tar.gz.new", tmpdir + f"{self._repo}.files.tar.gz")
-                self._update_meta('TIMESTAMP', remote_timestamp)
-            else:
-                logger.info(f"{self._repo}.files.tar.gz up to date, deleting {self._repo}.files.tar.gz.new")
-                os.remove(tmpdir + f"{self._repo}.files.tar.gz.new")
-
-        else:
-            resp = await self._download_file("{}/{}.files.tar.gz".format(self._mirror, self._repo), tmpdir + f"{self._repo}.files.tar.gz")
-            remote_timestamp = resp.headers['last-modified']
-            remote_timestamp = datetime.datetime.strptime(remote_timestamp, '%a, %d %b %Y %X GMT')
-            remote_timestamp = remote_timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
-            self._update_meta('TIMESTAMP', remote_timestamp)
-
-        files_compressed = tarfile.open(tmpdir + f"{self._repo}.files.tar.gz", "r")
-        logger.info(f"Extracting {self._repo}.files.tar.gz")
-        files_compressed.extractall(tmpdir + f"{self._repo}.files")
-        files_compressed.close()
-        #os.remove(tmpdir + "core.files.tar.gz")
-        #logger.info("Deleted core.files.tar.gz")
-        logger.info(f"Traversing ./temp/{self._repo}.files")
-
-        # Traverse ./temp/{repo}.files
-        self._newpkgs = 0
-        self._newpkgs_list = []
-        self._updatedpkgs = 0
-        self._updatedpkgs_list = []
+    async def _get_file_index(self, repo: str) -> list:
+        """
+        Read the files database of `repo`, queues a job for every package
+        whose man pages need updating and returns those packages
+        """
+        to_update = []
+        self._db.execute("""SELECT TIMESTAMP, ETAG FROM arch_meta WHERE REPO = ?;""", (repo,))
+        local = self._db.fetchone()
+        local_timestamp = local['TIMESTAMP']
+
+        # only download the files database if it changed since the last run
+        request_headers = {}
+        if local_timestamp:
+            request_headers['If-Modified-Since'] = email.utils.formatdate(local_timestamp, usegmt=True)
+        if local['ETAG']:
+            request_headers['If-None-Match'] = local['ETAG']
+
+        async def download(url):
+            async with self._session.get(url, headers=request_headers) as resp:
+                if resp.status == 304:
+                    return None
+                return await resp.read(), resp.headers['last-modified'], resp.headers.get('etag')
+
+        logger.info(f"Downloading {repo}.files.tar.gz")
+        downloaded = await self._mirrors.fetch(repo, f"{repo}.files.tar.gz", download)
+        if downloaded is None:
+            logger.info(f"{repo}.files.tar.gz up to date (not modified)")
+            return to_update
+        files_db, last_modified, etag = downloaded
+        remote_timestamp = self._parse_http_date(last_modified)
+
+        if remote_timestamp <= local_timestamp:
+            logger.info(f"{repo}.files.tar.gz up to date")
+            return to_update
+
+        # fingerprints of the packages we already have
+        self._db.execute("""SELECT NAME, FINGERPRINT FROM arch_packages WHERE REPO = ?""", (repo,))
+        known = dict(self._db.fetchall())
+
+        logger.info(f"Reading {repo}.files.tar.gz")
         havemanpkgs = 0
         totalpkgs = 0
-        for (root, dirs, files) in os.walk(tmpdir + f"{self._repo}.files", topdown=True):
-            if files != [] and 'files' in files and 'desc' in files: # root has no files
-                manpaths = self._read_files(root + '/' + 'files')
-                meta = self._read_desc(root + '/' + 'desc')
+        entries = {} # package directory -> {"desc": meta, "files": manpaths}
+        unchanged = set()
+        with tarfile.open(fileobj=io.BytesIO(files_db), mode="r|gz") as t:
+            for info in t:
+                if not info.isfile():
+                    continue
+                root, member = info.name.rsplit('/', 1)
+                if member not in ('desc', 'files') or root in unchanged:
+                    continue
+                text = t.extractfile(info).read().decode("utf-8", errors="replace")
+
+                entry = entries.setdefault(root, {})
+                if member == 'desc':
+                    entry['desc'] = self._read_desc(text, info.name)
+                    if known.get(entry['desc'].get('NAME')) == self._fingerprint(entry['desc']):
+                        # same build as last time, don't bother with its file list
+                        del entries[root]
+                        unchanged.add(root)
+                        havemanpkgs += 1
+                        totalpkgs += 1
+                        continue
+                else:
+                    entry['files'] = self._read_files(text)
+                if len(entry) < 2:
+                    continue
+                del entries[root]
+
+                manpaths = entry['files']
+                meta = entry['desc']
                 if manpaths and meta != None:
                     pkg = {
                             "name": meta["NAME"],
-                            "repo": self._repo,
+                            "repo": repo,
                             "version": meta["VERSION"],
                             "filename": meta['FILENAME'],
                             "arch": meta['ARCH'],
                             "upstream": meta['URL'],
                             "license": meta['LICENSE'],
-                            "url": f"{self._mirror}/{meta['FILENAME']}",
-                            "manpaths": manpaths
+                            "url": self._mirrors.best(repo, meta['FILENAME']),
+                            "manpaths": manpaths,
+                            "fingerprint": self._fingerprint(meta),
+                            "sha256": meta.get('SHA256SUM'),
                     }
-                    
-                    oldver = self._get_pkg(pkg['name'], 'VERSION')
-                    if oldver is None:
-                        # new entry
-                        self._db.execute(f"""INSERT INTO arch_packages (NAME, REPO, VERSION, FILENAME, ARCH, UPSTREAM, LICENSE, URL, MANPATHS)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
-                        """, (pkg['name'], pkg['repo'], pkg['version'], pkg['filename'], pkg['arch'], pkg['upstream'], pkg['license'], pkg['url'], json.dumps(pkg['manpaths']),))
-                        self._newpkgs += 1
-                        self._newpkgs_list.append(pkg)
+
+                    pkg['new'] = pkg['name'] not in known
+                    if pkg['new']:
                         logger.info(f"New package: {pkg['name']} {pkg['version']}")
-                    elif version.parse(pkg['version']) > version.parse(oldver):
-                            # downloaded version is newer, update
-                            self._db.execute(f"""UPDATE arch_packages
-                            SET VERSION = ?,
-                                FILENAME = ?,
-                                ARCH = ?,
-                                UPSTREAM = ?,
-                                LICENSE = ?,
-                                URL = ?,
-                                MANPATHS = ?,
-                            WHERE
-                                NAME = ?;
-                            """, (pkg['version'], pkg['filename'], pkg['arch'], pkg['upstream'], pkg['license'], pkg['url'], json.dumps(pkg['manpaths'],pkg['name'],)))
-                            logger.info(f"Package '{pkg['name']}' updated: {oldver} -> {pkg['version']}")
-                            self._updatedpkgs += 1
-                            self._updatedpkgs_list.append(pkg)
+                    else:
+                        logger.info(f"Package '{pkg['name']}' updated: {known[pkg['name']]} -> {pkg['fingerprint']}")
+                    to_update.append(pkg)
                     havemanpkgs += 1
                 totalpkgs += 1
 
-        self._update_meta('HAVEMAN_PKGS', havemanpkgs)
-        self._update_meta('TOTAL_PKGS', totalpkgs)
-        logger.info(f"Package database parsed: {self._newpkgs} new, {self._updatedpkgs} updated, {havemanpkgs} have man, {totalpkgs} total")
+        # arch_packages is only updated once the pages of a package are
+        # written, the jobs are saved along with the timestamp of the database
+        self._queue_jobs(repo, to_update)
+        self._update_meta(repo, 'TIMESTAMP', remote_timestamp)
+        self._update_meta(repo, 'ETAG', etag)
+        self._update_meta(repo, 'HAVEMAN_PKGS', havemanpkgs)
+        self._update_meta(repo, 'TOTAL_PKGS', totalpkgs)
+        logger.info(f"{repo} package database parsed: {len(to_update)} new or updated, {len(unchanged)} unchanged, {havemanpkgs} have man, {totalpkgs} total")
         self._con.commit()
+        return to_update
 
 
-    async def _get_man_contents(self, pkg: dict) -> tuple[list, list, list]:
+    def _read_package(self, fileobj, pkg: dict) -> tuple[list, list]:
         """
-        pkg: dict
-        {
-            "name": str,
-            "repo": str, #core/community/extra
-            "version": str,
-            "filename": str,
-            "url": str,
-            "manpaths": str #use json.loads
-        }
+        Pick the man pages of `pkg` out of its archive in a single forward pass
         """
-        path = tmpdir + 'pkgs/' + pkg['filename']
-        resp = await self._download_file(pkg['url'], path)
-        with tarfile.open(path, "r") as t:
-            #hardlinks = []
-            symlinks = []
-            files = []
-            for file in pkg['manpaths']:
-                info = t.getmember(file)
+        wanted = set(pkg['manpaths'])
+        contents = {} # raw member data, hardlink targets always come first in the archive
+        #hardlinks = []
+        symlinks = []
+        files = []
+        with _open_tar_stream(fileobj, pkg['filename']) as t:
+            for info in t:
+                if info.name not in wanted:
+                    continue
+                wanted.discard(info.name)
+                file = info.name
                 # just treat hardlinks like normal files because it's too hard
 #                if info.islnk():
 #                    target = info.linkname
@@ -456,120 +893,308 @@ class Indexer(object):
                         target = target[:-3]
                         symlinks.append( ("symlink", file, target) )
                 else:
-                    man = t.extractfile(file).read()
+                    if info.islnk():
+                        man = contents.get(info.linkname)
+                        if man is None:
+                            logger.warning(f"Skipping hardlink to unknown member: {file} -> {info.linkname}")
+                            continue
+                    else:
+                        man = t.extractfile(info).read()
+                        contents[file] = man
                     if file.endswith(".gz"):
                         file = file[:-3]
                         man = gzip.decompress(man)
-                        man = self._decode(man)
+                    try:
+                        lang = self._getmanpathinfo(file)[2]
+                    except UnknownManPath:
+                        lang = None
+                    man = self._decoder.decode(man, lang)
                     files.append( ("file", file, man))
+                if not wanted:
+                    # the rest of the package is of no interest
+                    break
         #return (files, symlinks, hardlinks,)
         return (files, symlinks,)
 
-    async def _update_man_pages(self):
-        # update self._updatedpkgs_list and self._newpkgs_list
-        to_update = self._updatedpkgs_list + self._newpkgs_list
-        logger.info(f"Updating man pages from {len(to_update)} packages")
-
-        updated_pages = 0
-
-        redirects = []
-        #hardlink_list= []
+    async def _get_man_contents(self, pkg: dict) -> tuple[list, list]:
+        """
+        pkg: dict
+        {
+            "name": str,
+            "repo": str, #core/community/extra
+            "version": str,
+            "filename": str,
+            "url": str,
+            "manpaths": str #use json.loads
+        }
+        """
+        sha256 = pkg.get('sha256')
+        if sha256:
+            f = self._pkgcache.open(pkg['filename'], sha256)
+            if f is not None:
+                logger.info(f"Reading {pkg['filename']} from the package cache")
+                with f:
+                    return await asyncio.to_thread(self._read_package, f, pkg)
+
+        if self._stream_packages:
+            # decompress and untar straight from the response body, a copy goes to the cache
+            def read(raw):
+                if not sha256:
+                    return self._read_package(io.BufferedReader(raw, buffer_size=1024*1024), pkg)
+                with self._pkgcache.writer(pkg['filename'], sha256) as f:
+                    body = io.BufferedReader(_TeeReader(raw, f), buffer_size=1024*1024)
+                    contents = self._read_package(body, pkg)
+                    while body.read(1024*1024): # the rest of the package, for the checksum
+                        pass
+                return contents
+
+            async def stream(url):
+                async with self._session.get(url) as resp:
+                    return await asyncio.to_thread(read, _ResponseReader(resp.content, asyncio.get_running_loop()))
+
+            contents = await self._mirrors.fetch(pkg['repo'], pkg['filename'], stream)
+            logger.info(f"Streamed {pkg['filename']}")
+            return contents
+
+        if sha256:
+            async def download(url):
+                with self._pkgcache.writer(pkg['filename'], sha256) as f:
+                    async with self._session.get(url) as resp:
+                        async for chunk in resp.content.iter_chunked(1024*1024):
+                            f.write(chunk)
+
+            await self._mirrors.fetch(pkg['repo'], pkg['filename'], download)
+            logger.info(f"Downloaded {pkg['filename']}")
+            f = self._pkgcache.open(pkg['filename'], sha256)
+            if f is not None:
+                with f:
+                    return await asyncio.to_thread(self._read_package, f, pkg)
+            # other downloads finished in between and needed the room
+            logger.warning(f"{pkg['filename']} was evicted from the package cache, downloading it again without caching it")
+
+        with tempfile.TemporaryFile() as f:
+            async def download_temp(url):
+                f.seek(0)
+                f.truncate()
+                async with self._session.get(url) as resp:
+                    async for chunk in resp.content.iter_chunked(1024*1024):
+                        f.write(chunk)
+            await self._mirrors.fetch(pkg['repo'], pkg['filename'], download_temp)
+            f.seek(0)
+            return await asyncio.to_thread(self._read_package, f, pkg)
 
-        for pkg in to_update:
+    async def _index_stage(self, packages: asyncio.Queue):
+        """
+        Read the files databases of all repos concurrently, each one's packages
+        are queued for download as soon as it has been read
+        """
+        async def index(repo):
+            indexed = await self._get_file_index(repo)
+            to_update = self._get_jobs(repo)
+            if len(to_update) > len(indexed):
+                logger.info(f"Resuming {len(to_update) - len(indexed)} unfinished packages from {repo}")
+            self._pbar.total += len(to_update)
+            self._pbar.refresh()
+            for pkg in to_update:
+                packages.put_nowait(pkg)
+
+        try:
+            await asyncio.gather(*(index(repo) for repo in self._repos))
+        finally:
+            for _ in range(self._max_downloads):
+                packages.put_nowait(None) # no more packages, one for each worker
+
+    async def _download_worker(self, packages: asyncio.Queue, downloaded: asyncio.Queue):
+        """
+        Download packages from `packages` until the end marker, handing the
+        extracted man pages over to the render stage through `downloaded`
+        """
+        while True:
+            pkg = await packages.get()
+            if pkg is None:
+                return
             files, symlinks = await self._get_man_contents(pkg)
-            for file in files:
-                html_content = mandoc_convert(file[2], "html")
-                txt_content = mandoc_convert(file[2], 'txt')
-                headings = json.dumps(extract_headings(html_content))
-                description = extract_description(txt_content)
-
-                self._insert_manpage(pkg['name'], file[1], headings, description, file[2], html_content, txt_content)
-
-                updated_pages += 1
-            #for hardlink in hardlinks:
-
-            #    # extract info from source
-            #    try:
-            #        source_name, source_section, source_lang = self._getmanpathinfo(hardlink[1])
-            #    except UnknownManPath:
-            #        logger.warning("Skipping hardlink with unrecognized source path: {}".format(hardlink[1]))
-            #        continue
-
-            #    # extract info from target
-            #    try:
-            #        target_name, target_section, target_lang = self._getmanpathinfo(hardlink[2])
-            #    except UnknownManPath:
-            #        logger.warning("Skipping hardlink with unrecognized target path: {}".format(hardlink[2]))
-            #        continue
-            #    
-            #    # drop encoding from the lang (ru.KOI8-R)
-            #    if "." in source_lang:
-            #        source_lang, _ = source_lang.split(".", maxsplit=1)
-            #    if "." in target_lang:
-            #        target_lang, _ = target_lang.split(".", maxsplit=1)
-
-            #    if target_lang == source_lang and target_section == source_section and target_name == source_name:
-            #        logger.warning("Skipping hardlink from {} to {} (the base name is the same).".format(source, target))
-            #        continue
-
-            #    hardlink_list.append((source_name, source_section, source_lang, target_name, target_section, target_lang,))
-
-            #    manpage = self._get_manpage(hardlink[2])
-            #    content = manpage['CONTENT']
-            #    html_content = manpage['HTML_CONTENT']
-            #    txt_content = manpage['TXT_CONTENT']
-            #    headings = json.dumps(extract_headings(html_content))
-            #    description = extract_description(txt_content)
-
-            #    self._insert_manpage(pkg['name'], hardlink[1], headings, description, content, html_content, txt_content)
-
-            for symlink in symlinks:
-                source, target = symlink[1], symlink[2]
-
-                try:
-                    source_name, source_section, source_lang = self._getmanpathinfo(source)
-                except UnknownManPath:
-                    logger.warning("Skipping symlink with unrecognized structure: {}".format(source))
-                    continue
+            await downloaded.put((pkg, files, symlinks))
+
+    async def _download_stage(self, packages: asyncio.Queue, downloaded: asyncio.Queue):
+        workers = [asyncio.create_task(self._download_worker(packages, downloaded)) for _ in range(self._max_downloads)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        await downloaded.put(None) # no more packages
+
+    async def _render_stage(self, downloaded: asyncio.Queue):
+        # bound the number of packages being rendered so downloads can't pile up in memory
+        slots = asyncio.Semaphore(self._render_workers * 2)
+        tasks = []
+        while True:
+            item = await downloaded.get()
+            if item is None:
+                break
+            await slots.acquire()
+            task = asyncio.create_task(self._render_package(*item))
+            task.add_done_callback(lambda _: slots.release())
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+
+    async def _render_page(self, file: tuple) -> tuple:
+        loop = asyncio.get_running_loop()
+        cached = self._render_cache.get(file[3])
+        page = await loop.run_in_executor(self._render_pool, _render_and_encode, file[2], self._encoding, cached)
+        render_cache = page.pop("RENDER_CACHE")
+        if render_cache is not None:
+            self._render_cache.put(file[3], *render_cache)
+        return file, page
+
+    async def _render_package(self, pkg: dict, files: list, symlinks: list):
+        # skip pages whose source didn't change since the last time they were rendered
+        hashes = self._get_content_hashes(pkg['repo'], pkg['name'])
+        changed = []
+        for file in files:
+            file_hash = content_hash(file[2])
+            if hashes.get(file[1]) != file_hash:
+                changed.append(file + (file_hash,))
+
+        # pages are rendered in the process pool and written as soon as each one is done
+        for job in asyncio.as_completed([self._render_page(file) for file in changed]):
+            file, page = await job
+
+            self._insert_manpage(pkg['repo'], pkg['name'], file[1], dict(page, CONTENT_HASH=file[3]))
+
+            self._updated_pages += 1
+        #for hardlink in hardlinks:
+
+        #    # extract info from source
+        #    try:
+        #        source_name, source_section, source_lang = self._getmanpathinfo(hardlink[1])
+        #    except UnknownManPath:
+        #        logger.warning("Skipping hardlink with unrecognized source path: {}".format(hardlink[1]))
+        #        continue
+
+        #    # extract info from target
+        #    try:
+        #        target_name, target_section, target_lang = self._getmanpathinfo(hardlink[2])
+        #    except UnknownManPath:
+        #        logger.warning("Skipping hardlink with unrecognized target path: {}".format(hardlink[2]))
+        #        continue
+        #    
+        #    # drop encoding from the lang (ru.KOI8-R)
+        #    if "." in source_lang:
+        #        source_lang, _ = source_lang.split(".", maxsplit=1)
+        #    if "." in target_lang:
+        #        target_lang, _ = target_lang.split(".", maxsplit=1)
+
+        #    if target_lang == source_lang and target_section == source_section and target_name == source_name:
+        #        logger.warning("Skipping hardlink from {} to {} (the base name is the same).".format(source, target))
+        #        continue
+
+        #    hardlink_list.append((source_name, source_section, source_lang, target_name, target_section, target_lang,))
+
+        #    manpage = self._get_manpage(hardlink[2])
+        #    content = manpage['CONTENT']
+        #    html_content = manpage['HTML_CONTENT']
+        #    txt_content = manpage['TXT_CONTENT']
+        #    headings = json.dumps(extract_headings(html_content))
+        #    description = extract_description(txt_content)
+
+        #    self._insert_manpage(pkg['name'], hardlink[1], headings, description, content, html_content, txt_content)
+
+        for symlink in symlinks:
+            redirect = self._symlink_redirect(symlink[1], symlink[2])
+            if redirect is not None:
+                self._redirects.append(redirect)
+                self._updated_pages += 1
+        # its job is marked committed with the pages
+        self._rendered_pkgs.append(pkg)
+        self._pbar.update(1)
+
+    def _symlink_redirect(self, source: str, target: str) -> Union[None, tuple]:
+        try:
+            source_name, source_section, source_lang = self._getmanpathinfo(source)
+        except UnknownManPath:
+            logger.warning("Skipping symlink with unrecognized structure: {}".format(source))
+            return None
 
-                if target.startswith("/"):
-                    # make target relative to "/"
-                    target = target[1:]
-                else:
-                    # make target full path
-                    ppt = PurePath(source).parent / target
-                    # normalize to remove any '..'
-                    target = os.path.normpath(ppt)
-
-                # extract info from target, check if it makes sense
-                try:
-                    target_name, target_section, target_lang = self._getmanpathinfo(target)
-                except UnknownManPath:
-                    logger.warning("Skipping symlink with unknown target: {}".format(target))
-                    continue
+        if target.startswith("/"):
+            # make target relative to "/"
+            target = target[1:]
+        else:
+            # make target full path
+            ppt = PurePath(source).parent / target
+            # normalize to remove any '..'
+            target = os.path.normpath(ppt)
+
+        # extract info from target, check if it makes sense
+        try:
+            target_name, target_section, target_lang = self._getmanpathinfo(target)
+        except UnknownManPath:
+            logger.warning("Skipping symlink with unknown target: {}".format(target))
+            return None
 
-                # drop encoding from the lang (ru.KOI8-R)
-                if "." in source_lang:
-                    source_lang, _ = source_lang.split(".", maxsplit=1)
-                if "." in target_lang:
-                    target_lang, _ = target_lang.split(".", maxsplit=1)
+        # drop encoding from the lang (ru.KOI8-R)
+        if "." in source_lang:
+            source_lang, _ = source_lang.split(".", maxsplit=1)
+        if "." in target_lang:
+            target_lang, _ = target_lang.split(".", maxsplit=1)
 
-                # drop cross-language symlinks
-                if target_lang != source_lang:
-                    logger.warning("Skipping cross-language symlink from {} to {}".format(source, target))
-                    continue
+        # drop cross-language symlinks
+        if target_lang != source_lang:
+            logger.warning("Skipping cross-language symlink from {} to {}".format(source, target))
+            return None
 
-                # drop useless redirects
-                if target_section == source_section and target_name == source_name:
-                    logger.warning("Skipping symlink from {} to {} (the base name is the same).".format(source, target))
-                    continue
+        # drop useless redirects
+        if target_section == source_section and target_name == source_name:
+            logger.warning("Skipping symlink from {} to {} (the base name is the same).".format(source, target))
+            return None
+
+        return (source_name, source_section, source_lang, target_name, target_section, target_lang,)
 
-                redirects.append((source_name, source_section, source_lang, target_name, target_section, target_lang,))
-                updated_pages += 1
+    async def _update_man_pages(self):
+        """
+        Index all repos and update the man pages of new and updated packages
+
+        The repos share one pipeline: their files databases are read
+        concurrently, packages from all of them go through the same download
+        workers and render pool, and everything is written by this process
+        through its single connection.
+
+        Progress is kept in arch_jobs, a run that is interrupted leaves its
+        unfinished packages there and the next run picks them up. A job is
+        either pending or committed, an unfinished one is redone as a whole:
+        its package is read back from the package cache and pages that were
+        already written are skipped by their hash.
+        """
+        logger.info(f"Updating man pages from {', '.join(self._repos)}")
+        self._newpkgs = 0
+        self._updatedpkgs = 0
+        self._updated_pages = 0
 
-        self._insert_redirects(redirects)
+        self._pending_pages = []
+        self._redirects = []
+        self._rendered_pkgs = []
+        #hardlink_list= []
 
-        self._con.commit()
+        self._pbar = tqdm(total=0, unit="pkg") # grows as repos are read
+        packages = asyncio.Queue()
+        # downloads run ahead of rendering, but at most `max_downloads` packages are buffered
+        downloaded = asyncio.Queue(maxsize=self._max_downloads)
+        stages = [
+            asyncio.create_task(self._index_stage(packages)),
+            asyncio.create_task(self._download_stage(packages, downloaded)),
+            asyncio.create_task(self._render_stage(downloaded)),
+        ]
+        try:
+            done, pending = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+            for stage in pending:
+                stage.cancel()
+            for stage in done:
+                stage.result() # re-raise
+        finally:
+            self._pbar.close()
+
+        self._flush_manpages()
 
         # Useless
         self._db.execute('SELECT COUNT(*) from arch_manpages')
@@ -578,23 +1203,25 @@ class Indexer(object):
         redirect_count = self._db.fetchone()[0]
         self._db.execute('SELECT COUNT(*) from arch_packages')
         pkg_count = self._db.fetchone()[0]
-        self._updated_pages = updated_pages
         logger.info(f"DB contains {manpage_count} manpages and {redirect_count} symlinks from {pkg_count} packages")
+        logger.info(f"Decoded pages: {self._decoder.summary()}")
 
     def _postprocess(self):
-        resolve_so_links(self._db)
+        resolve_so_links(self._db, self.INDEXER_STARTTIME)
+        if self._updated_pages:
+            search.tidy(self._db, self._updated_pages)
 
     async def main(self):
-        await self._get_file_index()
         await self._update_man_pages()
         self._postprocess()
         self.INDEXER_ENDTIME = int(time.time())
         self._insert_execution()
         self._con.commit()
 
-async def main():
-    async with Indexer("core", "packages.db") as indexer:
+async def main(repos: list = REPOS, mirrorlist: Union[None, str] = MIRRORLIST):
+    async with Indexer(repos, "packages.db", mirrorlist=mirrorlist) as indexer:
         await indexer.main()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # python -m indexer.indexer [repo ...]
+    asyncio.run(main(sys.argv[1:] or REPOS))
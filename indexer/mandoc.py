@@ -0,0 +1,128 @@
+"""
+Running mandoc
+
+Every conversion used to start a shell and a mandoc process. When mandocd(8),
+the mandoc server shipped with mandoc, is installed, one is kept running per
+output format instead: each page is handed over as a set of file descriptors
+(input, output, errors) sent over a unix socket. Otherwise mandoc is spawned
+for every conversion, without a shell.
+
+A mandocd that died or stopped answering is replaced, and a page it gave no
+output for is converted by a spawned mandoc, so that a failure of the daemon
+never turns into an empty page.
+"""
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import threading
+
+logger = logging.getLogger("Indexer")
+
+ARGUMENTS = {
+    "html": ["-T", "html", "-O", "fragment"],
+    "txt": ["-T", "utf8"],
+}
+
+
+class MandocdError(Exception):
+    pass
+
+
+class Mandocd(object):
+    """
+    A mandocd process for one output format, converts one page at a time
+    """
+
+    def __init__(self, fmt: str):
+        self._pid = os.getpid()
+        self._sock, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        with theirs:
+            self._process = subprocess.Popen(["mandocd", *ARGUMENTS[fmt], str(theirs.fileno())], pass_fds=(theirs.fileno(),),
+                stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._lock = threading.Lock()
+
+    def alive(self) -> bool:
+        # a forked child can't share the socket with its parent
+        return self._pid == os.getpid() and self._process.poll() is None
+
+    def convert(self, content: str) -> str:
+        data = content.encode("utf-8")
+        with self._lock:
+            # the input is complete before mandocd starts reading, so the output pipe can't deadlock
+            input_fd = os.memfd_create("mandoc-input")
+            output_fd, write_fd = os.pipe()
+            try:
+                with open(input_fd, "wb", closefd=False) as f:
+                    f.write(data)
+                os.lseek(input_fd, 0, os.SEEK_SET)
+                with open(os.devnull, "wb") as errors:
+                    socket.send_fds(self._sock, [b"\0"], [input_fd, write_fd, errors.fileno()])
+            except OSError as e:
+                # BrokenPipeError, ConnectionResetError... once mandocd is gone
+                os.close(output_fd)
+                raise MandocdError(f"mandocd didn't take the page: {e!r}") from e
+            finally:
+                # mandocd closes its copies when it's done, which ends the output
+                os.close(input_fd)
+                os.close(write_fd)
+            with open(output_fd, "rb") as f:
+                output = f.read()
+        return output.decode("utf-8")
+
+    def close(self):
+        self._sock.close()
+        self._process.wait()
+
+    def kill(self):
+        self._sock.close()
+        self._process.kill()
+        self._process.wait()
+
+
+_daemons = {}
+_daemons_lock = threading.Lock()
+_have_mandocd = None
+
+def _daemon(fmt: str) -> Mandocd:
+    with _daemons_lock:
+        daemon = _daemons.get(fmt)
+        if daemon is None or not daemon.alive():
+            daemon = _daemons[fmt] = Mandocd(fmt)
+        return daemon
+
+def _discard(fmt: str, daemon: Mandocd):
+    with _daemons_lock:
+        if _daemons.get(fmt) is daemon:
+            del _daemons[fmt]
+    if daemon.alive():
+        daemon.kill()
+
+def spawn(content: str, fmt: str) -> str:
+    p = subprocess.run(["mandoc", *ARGUMENTS[fmt]], check=True, input=content, encoding="utf-8", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return p.stdout
+
+def convert(content: str, fmt: str) -> str:
+    """
+    Output of mandoc for `content`, fmt is "html" or "txt"
+    """
+    global _have_mandocd
+    if _have_mandocd is None:
+        _have_mandocd = shutil.which("mandocd") is not None
+    if not _have_mandocd:
+        return spawn(content, fmt)
+    daemon = _daemon(fmt)
+    try:
+        output = daemon.convert(content)
+    except MandocdError as e:
+        logger.warning(f"Restarting mandocd ({fmt}): {e}")
+        _discard(fmt, daemon)
+        return spawn(content, fmt)
+    if not output:
+        # mandocd died while converting, or the page really is empty, mandoc tells
+        if not daemon.alive():
+            logger.warning(f"Restarting mandocd ({fmt}), it exited")
+            _discard(fmt, daemon)
+        return spawn(content, fmt)
+    return output
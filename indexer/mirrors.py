@@ -0,0 +1,134 @@
+"""
+Pool of Arch Linux mirrors, downloads are spread over the fastest ones and
+fail over to the others
+"""
+import asyncio
+import logging
+import re
+import time
+
+from typing import Awaitable, Callable, Union
+
+import aiohttp
+
+logger = logging.getLogger("Indexer")
+
+PROBE_TIMEOUT = 10 # seconds per mirror
+POOL_SIZE = 4 # fastest mirrors used for downloads
+MAX_ATTEMPTS = 5 # per download, over all mirrors
+RETRY_BACKOFF = 0.5 # seconds, doubled after every failed attempt
+MAX_FAILURES = 3 # consecutive failures before a mirror is dropped
+
+# 404 is included, mirrors that aren't synced yet don't have new packages
+RETRY_STATUSES = {404, 408, 425, 429, 500, 502, 503, 504}
+
+
+class MirrorError(Exception):
+    """
+    Bad data from a mirror, always retried on another one
+    """
+    pass
+
+
+def read_mirrorlist(text: str) -> list:
+    """
+    Server urls of a pacman mirrorlist, in the order they are listed
+    """
+    return re.findall(r"^\s*Server\s*=\s*(\S+)", text, flags=re.MULTILINE)
+
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+    return isinstance(error, (MirrorError, aiohttp.ClientError, asyncio.TimeoutError, ConnectionError))
+
+
+class MirrorPool(object):
+    """
+    servers: mirrorlist urls with $repo and $arch placeholders
+    """
+
+    def __init__(self, servers: list, arch: str, size: int = POOL_SIZE):
+        if not servers:
+            raise ValueError("No mirrors configured")
+        self._servers = list(servers)
+        self._arch = arch
+        self._size = size
+        self._active = self._servers[:size] # ranked, fastest first
+        self._failures = {server: 0 for server in self._servers}
+        self._next = 0
+
+    def url(self, server: str, repo: str, filename: str) -> str:
+        return server.replace("$repo", repo).replace("$arch", self._arch).rstrip("/") + "/" + filename
+
+    def best(self, repo: str, filename: str) -> str:
+        return self.url(self._active[0], repo, filename)
+
+    async def _probe_one(self, session: aiohttp.ClientSession, server: str, repo: str) -> Union[None, float]:
+        start = time.monotonic()
+        try:
+            async with session.get(self.url(server, repo, f"{repo}.db"), timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as resp:
+                resp.raise_for_status()
+                size = len(await resp.read())
+        except Exception as e:
+            logger.warning(f"Mirror {server} failed the probe: {e!r}")
+            return None
+        elapsed = time.monotonic() - start
+        logger.info(f"Mirror {server}: {elapsed * 1000:.0f} ms for {size} bytes")
+        return elapsed
+
+    async def probe(self, repo: str, headers: Union[None, dict] = None):
+        """
+        Download the (small) package database of `repo` from every mirror and
+        keep the `size` fastest, the time includes both latency and throughput
+
+        The probes run on a session of their own without a connection limit:
+        on the (limited) download session the time spent waiting for a
+        connection would be counted as well.
+        """
+        if len(self._servers) == 1:
+            return
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0), headers=headers) as session:
+            timings = await asyncio.gather(*(self._probe_one(session, server, repo) for server in self._servers))
+        ranked = sorted((elapsed, i) for i, elapsed in enumerate(timings) if elapsed is not None)
+        if not ranked:
+            logger.warning("No mirror answered the probe, keeping the mirrorlist order")
+            return
+        self._active = [self._servers[i] for _, i in ranked[:self._size]]
+        logger.info(f"Using mirrors: {', '.join(self._active)}")
+
+    def _order(self) -> list:
+        # start at the next mirror for every download, the others are fallbacks
+        start = self._next % len(self._active)
+        self._next += 1
+        fallbacks = [server for server in self._servers if server not in self._active]
+        return self._active[start:] + self._active[:start] + fallbacks
+
+    def _failed(self, server: str):
+        self._failures[server] += 1
+        if self._failures[server] >= MAX_FAILURES and server in self._active and len(self._active) > 1:
+            self._active.remove(server)
+            logger.warning(f"Dropped mirror {server} after {MAX_FAILURES} failures in a row")
+
+    async def fetch(self, repo: str, filename: str, attempt: Callable[[str], Awaitable]):
+        """
+        Run `attempt(url)` with the url of `filename` on a mirror, retrying
+        with backoff on the next mirrors if it fails with a network error or
+        a retryable status. The last error is raised when all attempts fail.
+        """
+        servers = self._order()
+        for i in range(MAX_ATTEMPTS):
+            server = servers[i % len(servers)]
+            try:
+                result = await attempt(self.url(server, repo, filename))
+            except Exception as e:
+                if not _retryable(e):
+                    raise
+                self._failed(server)
+                if i == MAX_ATTEMPTS - 1:
+                    raise
+                delay = RETRY_BACKOFF * 2 ** i
+                logger.warning(f"Downloading {filename} from {server} failed ({e!r}), retrying in {delay:.1f} s")
+                await asyncio.sleep(delay)
+            else:
+                self._failures[server] = 0
+                return result
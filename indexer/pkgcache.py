@@ -0,0 +1,136 @@
+"""
+Downloaded packages, kept between runs
+
+Packages are stored as <sha256>-<filename>, the checksum is the %SHA256SUM%
+of the files database, so a cached file is only reused for the very same
+build and every download is verified before it is added. The cache is
+bounded by the total size of its files, the least recently used ones are
+evicted first (the mtime of a file is its last use).
+
+Downloads finish in worker threads, the entries and their total size are
+guarded by a lock.
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import BinaryIO, Union
+
+from .mirrors import MirrorError
+
+logger = logging.getLogger("Indexer")
+
+_ENTRY = re.compile(r"^[0-9a-f]{64}-")
+
+
+class ChecksumMismatch(MirrorError):
+    pass
+
+
+class _HashingFile(object):
+    def __init__(self, f):
+        self._f = f
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+    def close(self):
+        self._f.close()
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+class PackageCache(object):
+
+    def __init__(self, directory: str, max_bytes: int):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            if not _ENTRY.match(name) or name.endswith(".part"):
+                # unfinished downloads and packages saved by older versions
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        self._entries = OrderedDict((name, size) for _, name, size in sorted(entries)) # least recently used first
+        self._size = sum(self._entries.values())
+        self._evict()
+        logger.info(f"Package cache: {len(self._entries)} packages, {self._size / 2**20:.0f} MiB in {directory}")
+
+    def _name(self, filename: str, sha256: str) -> str:
+        return f"{sha256}-{filename}"
+
+    def _evict(self, keep: str = None):
+        # with the lock held
+        for name in list(self._entries):
+            if self._size <= self._max_bytes:
+                break
+            if name == keep:
+                continue
+            self._size -= self._entries.pop(name)
+            os.remove(os.path.join(self._directory, name))
+            logger.info(f"Evicted {name} from the package cache")
+
+    def open(self, filename: str, sha256: str) -> Union[None, BinaryIO]:
+        """
+        The cached package opened for reading, None if it isn't cached
+
+        The file stays readable if the package is evicted while it's open.
+        """
+        name = self._name(filename, sha256)
+        path = os.path.join(self._directory, name)
+        with self._lock:
+            if name not in self._entries:
+                return None
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                # removed behind the cache's back
+                self._size -= self._entries.pop(name)
+                return None
+            self._entries.move_to_end(name)
+            os.utime(f.fileno())
+        return f
+
+    @contextmanager
+    def writer(self, filename: str, sha256: str):
+        """
+        File object to download a package to, it is added to the cache if
+        the block finishes and the checksum matches. Raises ChecksumMismatch
+        otherwise.
+        """
+        name = self._name(filename, sha256)
+        path = os.path.join(self._directory, name)
+        # one part file per download, the same package can be written by two of them
+        fd, part = tempfile.mkstemp(suffix=".part", prefix=name + ".", dir=self._directory)
+        f = _HashingFile(os.fdopen(fd, "wb"))
+        try:
+            yield f
+            f.close()
+            if f.hexdigest() != sha256:
+                raise ChecksumMismatch(f"{filename}: expected sha256 {sha256}, got {f.hexdigest()}")
+            with self._lock:
+                os.replace(part, path)
+                self._size += f.size - self._entries.pop(name, 0)
+                self._entries[name] = f.size
+                self._evict(keep=name)
+        finally:
+            f.close()
+            if os.path.exists(part):
+                os.remove(part)
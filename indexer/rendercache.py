@@ -0,0 +1,74 @@
+"""
+Renderings of man pages, kept between runs in their own database
+
+Entries are keyed by the hash of the roff source and the mandoc binary, so a
+page shipped by several packages, locales or versions is rendered once. Both
+the output of mandoc and the postprocessed rendering are kept: after a change
+of POSTPROCESS_VERSION only postprocess() runs again, after a change of
+mandoc the entries of the old binary are dropped.
+"""
+import json
+import logging
+import sqlite3
+
+import zstandard
+
+from typing import Union
+
+logger = logging.getLogger("Indexer")
+
+
+def pack(*values) -> bytes:
+    return zstandard.ZstdCompressor(level=3).compress(json.dumps(values).encode("utf-8"))
+
+def unpack(blob: bytes) -> list:
+    return json.loads(zstandard.ZstdDecompressor().decompress(blob))
+
+
+class RenderCache(object):
+    """
+    path: sqlite database, created if needed
+    mandoc: version of mandoc, see util.mandoc_version
+    """
+
+    def __init__(self, path: str, mandoc: str):
+        self._mandoc = mandoc
+        self._con = sqlite3.connect(path)
+        self._con.execute("""CREATE TABLE IF NOT EXISTS renders (
+            CONTENT_HASH TEXT,
+            MANDOC TEXT,
+            RAW BLOB, -- pack(html, txt) of mandoc
+            POSTPROCESS INTEGER, -- POSTPROCESS_VERSION of RENDERED
+            RENDERED BLOB, -- pack(html, txt, headings, description)
+            PRIMARY KEY (CONTENT_HASH, MANDOC)
+        ) WITHOUT ROWID;
+        """)
+        dropped = self._con.execute("""DELETE FROM renders WHERE MANDOC != ?""", (mandoc,)).rowcount
+        if dropped:
+            logger.info(f"Dropped {dropped} renderings of another mandoc from the render cache")
+        self._con.commit()
+
+    def get(self, content_hash: str) -> Union[None, tuple]:
+        """
+        (POSTPROCESS, RAW, RENDERED) of the page, None if it was never rendered
+        """
+        return self._con.execute("""SELECT POSTPROCESS, RAW, RENDERED FROM renders
+        WHERE CONTENT_HASH = ? AND MANDOC = ?""", (content_hash, self._mandoc)).fetchone()
+
+    def put(self, content_hash: str, raw: Union[None, bytes], postprocess: int, rendered: bytes):
+        """
+        raw: None to keep the one already cached
+        """
+        self._con.execute("""INSERT INTO renders (CONTENT_HASH, MANDOC, RAW, POSTPROCESS, RENDERED)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(CONTENT_HASH, MANDOC) DO UPDATE SET
+            RAW = COALESCE(excluded.RAW, RAW),
+            POSTPROCESS = excluded.POSTPROCESS,
+            RENDERED = excluded.RENDERED;
+        """, (content_hash, self._mandoc, raw, postprocess, rendered))
+
+    def commit(self):
+        self._con.commit()
+
+    def close(self):
+        self._con.close()
@@ -0,0 +1,141 @@
+"""
+Full-text search over the man pages, shared by the indexer and the web app
+
+arch_search is an FTS5 table whose rowid is arch_manpages.ID. The text is
+kept in the table itself, arch_contents only holds compressed blobs which
+FTS5 can't read for snippets. LOCALE is indexed as a single token so that
+the locale filter is part of the MATCH and no join is needed for ranking.
+
+Results come in tiers, each ranked by bm25: pages whose name starts with
+the query, then pages matching in their name, description or headings and
+finally pages matching only in their contents. The earlier tiers are small,
+so ranking the first result pages stays cheap even for very common words.
+"""
+import json
+import re
+
+from html import escape
+from typing import Union
+
+# bm25 weights of NAME, DESCRIPTION, HEADINGS, CONTENT and LOCALE
+WEIGHTS = (10.0, 4.0, 2.0, 1.0, 0.0)
+SNIPPET_TOKENS = 24
+MERGE_PAGES = 2000 # database pages written by merge() at most
+OPTIMIZE_FRACTION = 0.2 # of the pages updated in a run, above it the whole index is rebuilt by tidy()
+
+# private use characters, not found in man pages and left alone by html escaping
+_MARK_START = "\ue000"
+_MARK_END = "\ue001"
+_WORD = re.compile(r"\w+")
+_NON_ALNUM = re.compile(r"\W|_")
+_OVERSTRIKE = re.compile(r".\x08")
+
+
+def create_table(db):
+    db.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS arch_search USING fts5(
+        NAME, DESCRIPTION, HEADINGS, CONTENT, LOCALE,
+        tokenize = "unicode61 remove_diacritics 2",
+        prefix = '2 3'
+    )""")
+
+def _locale_token(locale: str) -> str:
+    # pt_BR and sr@latin would be split into several tokens
+    return _NON_ALNUM.sub("", locale).lower()
+
+def _headings_text(headings: Union[None, str]) -> str:
+    if not headings:
+        return ""
+    return " ".join(heading['title'] for heading in json.loads(headings))
+
+def _plain_text(txt: Union[None, str]) -> str:
+    # mandoc -T utf8 marks bold and underlined text with backspaces
+    return _OVERSTRIKE.sub("", txt or "")
+
+def index_pages(db, pages):
+    """
+    (Re)index pages, given as dicts with ID, NAME, LOCALE, DESCRIPTION, HEADINGS and TXT
+    """
+    pages = [dict(page, LOCALE=_locale_token(page['LOCALE']), HEADINGS=_headings_text(page['HEADINGS']), TXT=_plain_text(page['TXT'])) for page in pages]
+    db.executemany("""DELETE FROM arch_search WHERE rowid = :ID""", pages)
+    db.executemany("""INSERT INTO arch_search (rowid, NAME, DESCRIPTION, HEADINGS, CONTENT, LOCALE)
+    VALUES (:ID, :NAME, :DESCRIPTION, :HEADINGS, :TXT, :LOCALE)""", pages)
+
+def optimize(db):
+    """
+    Merge the b-trees written by incremental updates, keeps queries fast
+
+    This rewrites the whole index, see tidy() for updates of a few pages.
+    """
+    db.execute("""INSERT INTO arch_search (arch_search) VALUES ('optimize')""")
+
+def merge(db, pages: int = MERGE_PAGES):
+    """
+    Some of the merging optimize() does, only where enough b-trees piled up
+    and at most `pages` database pages
+    """
+    db.execute("""INSERT INTO arch_search (arch_search, rank) VALUES ('merge', ?)""", (pages,))
+
+def tidy(db, updated: int):
+    """
+    Merge after `updated` pages were (re)indexed: optimize() after large
+    updates, a bounded merge() otherwise
+    """
+    db.execute("""SELECT COUNT(*) FROM arch_manpages""")
+    if updated > OPTIMIZE_FRACTION * db.fetchone()[0]:
+        optimize(db)
+    else:
+        merge(db)
+
+def match_expressions(query: str, locale: Union[None, str] = None) -> list:
+    """
+    FTS5 queries of the result tiers of a user query, empty if it has no words
+
+    All words have to match, names also match if they start with the query.
+    The words are quoted, so FTS5 syntax typed by users can't cause errors.
+    Every tier names its columns, LOCALE is only matched by the locale filter.
+    """
+    words = _WORD.findall(query)
+    if not words:
+        return []
+    terms = " ".join(f'"{word}"' for word in words)
+    name = f'NAME : ^"{" ".join(words)}"*'
+    metadata = f"{{NAME DESCRIPTION HEADINGS}} : ({terms})"
+    content = f"{{NAME DESCRIPTION HEADINGS CONTENT}} : ({terms})"
+    tiers = [name, f"{metadata} NOT {name}", f"{content} NOT {metadata}"]
+    if locale:
+        tiers = [f'({tier}) AND LOCALE : "{_locale_token(locale)}"' for tier in tiers]
+    return tiers
+
+def search(db, query: str, locale: Union[None, str] = None, limit: int = 20, offset: int = 0) -> list:
+    """
+    Ranked results of `query`, see the module docstring for the order
+    """
+    results = []
+    for expression in match_expressions(query, locale):
+        db.execute(f"""SELECT m.NAME, m.SECTION, m.LOCALE, m.DESCRIPTION, r.SNIPPET FROM (
+            SELECT rowid, bm25(arch_search, {", ".join(map(str, WEIGHTS))}) AS SCORE,
+                snippet(arch_search, 3, '{_MARK_START}', '{_MARK_END}', '…', {SNIPPET_TOKENS}) AS SNIPPET
+            FROM arch_search
+            WHERE arch_search MATCH ?
+            ORDER BY SCORE
+            LIMIT ? OFFSET ?
+        ) r
+        CROSS JOIN arch_manpages m ON m.ID = r.rowid -- the planner would rather run the subquery per page
+        ORDER BY r.SCORE""", (expression, limit - len(results), offset,))
+        rows = db.fetchall()
+        results += rows
+        if len(results) >= limit:
+            break
+        if rows:
+            offset = 0
+        elif offset:
+            # the whole tier was skipped
+            db.execute("""SELECT COUNT(*) FROM arch_search WHERE arch_search MATCH ?""", (expression,))
+            offset = max(offset - db.fetchone()[0], 0)
+    return results
+
+def highlight(snippet: Union[None, str]) -> str:
+    """
+    html of a snippet returned by search(), with the matches in <mark>
+    """
+    return escape(snippet or "").replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>")
@@ -0,0 +1,100 @@
+"""
+Encoding of the arch_contents blobs, shared by the indexer and the web app
+
+With the "gzip" encoding CONTENT, HTML_CONTENT and TXT_CONTENT are gzip
+files and HTML_ZSTD and TXT_ZSTD hold the same renderings as zstd frames,
+so that they can be sent to clients as they are.
+
+The html of large pages is also stored cut at its sections, in the rows of
+arch_html_chunks. Every chunk is encoded on its own, with the ENCODING of
+the page, and the chunks are streamed one after the other.
+"""
+import gzip
+import struct
+import zlib
+
+import zstandard
+
+from typing import Iterable, Iterator, Union
+
+
+def _gzip(data: bytes) -> bytes:
+    # the sync flush leaves the deflate stream byte-aligned before the final
+    # (empty) block, so other deflate data can be spliced around it
+    c = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH) + c.flush(zlib.Z_FINISH)
+
+def _crc32_combine(crc1: int, crc2: int, len2: int) -> int:
+    # crc32 is affine, zlib.crc32 of zeros does the shifting in C
+    zeros = bytes(len2)
+    return zlib.crc32(zeros, crc1) ^ crc2 ^ zlib.crc32(zeros)
+
+_GZIP_HEADER = _gzip(b"")[:10]
+
+def encode(text: Union[None, str], encoding: Union[None, str]) -> Union[None, str, bytes]:
+    if text is None or encoding is None:
+        return text
+    if encoding == "gzip":
+        return _gzip(text.encode("utf-8"))
+    raise ValueError(f"Unknown content encoding: {encoding}")
+
+def encode_zstd(text: Union[None, str], encoding: Union[None, str]) -> Union[None, bytes]:
+    """
+    zstd variant stored next to the gzip one, None if the contents aren't compressed
+    """
+    if text is None or encoding is None:
+        return None
+    return zstandard.ZstdCompressor(level=10).compress(text.encode("utf-8"))
+
+def encode_chunks(chunks: list, encoding: Union[None, str]) -> list:
+    """
+    (HTML_CONTENT, HTML_ZSTD) of each chunk of a page, for arch_html_chunks
+    """
+    return [(encode(chunk, encoding), encode_zstd(chunk, encoding)) for chunk in chunks]
+
+def decode(blob: Union[None, str, bytes], encoding: Union[None, str]) -> Union[None, str]:
+    if blob is None or encoding is None:
+        return blob
+    if encoding == "gzip":
+        return gzip.decompress(blob).decode("utf-8")
+    raise ValueError(f"Unknown content encoding: {encoding}")
+
+def stream_gzip(head: bytes, blobs: Iterable[bytes], tail: bytes) -> Iterator[bytes]:
+    """
+    Pieces of a gzip file of head + the contents of each of `blobs` + tail,
+    without decompressing the blobs, which are only read as they're needed
+    """
+    c = zlib.compressobj(6, zlib.DEFLATED, -15)
+    yield _GZIP_HEADER + c.compress(head) + c.flush(zlib.Z_SYNC_FLUSH)
+    crc, size = zlib.crc32(head), len(head)
+    for blob in blobs:
+        blob_crc, blob_size = struct.unpack("<II", blob[-8:])
+        crc = _crc32_combine(crc, blob_crc, blob_size)
+        size += blob_size
+        yield blob[10:-10] # body without the final empty block
+
+    c = zlib.compressobj(6, zlib.DEFLATED, -15)
+    crc = _crc32_combine(crc, zlib.crc32(tail), len(tail))
+    size = (size + len(tail)) & 0xffffffff
+    yield c.compress(tail) + c.flush(zlib.Z_FINISH) + struct.pack("<II", crc, size)
+
+def stream_zstd(head: bytes, blobs: Iterable[bytes], tail: bytes) -> Iterator[bytes]:
+    """
+    Pieces of zstd data of head + the contents of each of `blobs` + tail, decoders handle concatenated frames
+    """
+    c = zstandard.ZstdCompressor(level=3)
+    yield c.compress(head)
+    yield from blobs
+    yield c.compress(tail)
+
+def splice_gzip(head: bytes, blob: bytes, tail: bytes) -> bytes:
+    """
+    gzip file of head + the contents of `blob` + tail, without decompressing `blob`
+    """
+    return b"".join(stream_gzip(head, [blob], tail))
+
+def splice_zstd(head: bytes, blob: bytes, tail: bytes) -> bytes:
+    """
+    zstd data of head + the contents of `blob` + tail
+    """
+    return b"".join(stream_zstd(head, [blob], tail))
@@ -1,14 +1,19 @@
 import logging
+import hashlib
+import json
 import re
+import shutil
 import textwrap
 import unicodedata
 
 from pathlib import PurePath
+from typing import Union
 
-import subprocess
 
 import sys
 
+from . import mandoc, search, storage
+
 ROOT_URL = "https://man.parabolas.xyz/"
 
 class CustomFormatter(logging.Formatter):
@@ -67,13 +72,44 @@ class ProgressBar(object):
 
 ## man2html (https://gitlab.archlinux.org/archlinux/archmanweb/-/blob/master/archmanweb/utils/mandoc.py) ##
 
+def run_mandoc(content, fmt):
+    """
+    Output of mandoc, before postprocess()
+    """
+    return mandoc.convert(content, fmt)
+
 def mandoc_convert(content, fmt):
-    if fmt == "html":
-        cmd = "mandoc -T html -O fragment"
-    elif fmt == "txt":
-        cmd = "mandoc -T utf8"
-    p = subprocess.run(cmd, shell=True, check=True, input=content, encoding="utf-8", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return postprocess(p.stdout, fmt)
+    return postprocess(run_mandoc(content, fmt), fmt)
+
+def mandoc_version():
+    """
+    Identifies the mandoc binary in use, its output can change with it
+    """
+    path = shutil.which("mandoc")
+    if path is None:
+        raise FileNotFoundError("mandoc not found")
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def content_hash(content):
+    """
+    Hash of the roff source of a man page, used to detect changed pages
+    """
+    return hashlib.sha256(content.encode("utf-8", errors="surrogateescape")).hexdigest()
+
+def render_manpage(content, raw=None):
+    """
+    Render a man page to html and txt, returns (html, txt, headings, description)
+
+    raw: (html, txt) output of mandoc for `content`, mandoc is run if not given
+    """
+    if raw is None:
+        raw = run_mandoc(content, "html"), run_mandoc(content, "txt")
+    html_content, headings = postprocess_html(raw[0])
+    txt_content = postprocess(raw[1], "txt")
+    headings = json.dumps(headings)
+    description = extract_description(txt_content)
+    return html_content, txt_content, headings, description
 
 def normalize_html_entities(s):
     def repl(match):
@@ -86,15 +122,44 @@ def normalize_html_entities(s):
 
 # escape sensitive characters when formatting an element attribute
 # https://stackoverflow.com/a/7382028
+_ATTRIBUTE_ESCAPES = str.maketrans({
+    "<"  : "&lt;",
+    ">"  : "&gt;",
+    "\"" : "&quot;",
+    "'"  : "&apos;",
+    "&"  : "&amp;",
+})
+
 def safe_escape_attribute(attribute):
-    escape_map = {
-        "<"  : "&lt;",
-        ">"  : "&gt;",
-        "\"" : "&quot;",
-        "'"  : "&apos;",
-        "&"  : "&amp;",
-    }
-    return "".join(escape_map.get(c, c) for c in attribute)
+    return attribute.translate(_ATTRIBUTE_ESCAPES)
+
+class _HrefEncoding(dict):
+    """
+    str.translate() table of anchorencode_href, the ASCII range is filled in
+    advance and other characters the first time they're encoded
+    """
+    # encode sensitive characters - the output of anchorencode_href should be usable
+    # in various markup languages (MediaWiki, FluxBB, etc.)
+    encode_chars = "[]|"
+
+    def __init__(self):
+        super().__init__()
+        for code in range(128):
+            self.__missing__(code)
+
+    def __missing__(self, code):
+        char = chr(code)
+        # encode characters from encode_chars and the Separator and Other categories
+        # https://en.wikipedia.org/wiki/Unicode#General_Category_property
+        if char in self.encode_chars or unicodedata.category(char)[0] in {"Z", "C"}:
+            encoded = "".join("%{:02X}".format(byte) for byte in char.encode("utf-8"))
+        else:
+            encoded = char
+        self[code] = encoded
+        return encoded
+
+_HREF_ENCODING = _HrefEncoding()
+_PERCENT_OCTET = re.compile(r"%([a-fA-F0-9]{2})")
 
 # adapted from `anchorencode` in wiki-scripts (the "legacy" format was removed):
 # https://github.com/lahwaacz/wiki-scripts/blob/master/ws/parser_helpers/encodings.py#L119-L152
@@ -109,24 +174,9 @@ def anchorencode_href(str_, *, input_is_already_id=False):
     if input_is_already_id is False:
         str_ = anchorencode_id(str_)
     # encode "%" from percent-encoded octets
-    str_ = re.sub(r"%([a-fA-F0-9]{2})", r"%25\g<1>", str_)
-    # encode sensitive characters - the output of this function should be usable
-    # in various markup languages (MediaWiki, FluxBB, etc.)
-    encode_chars = "[]|"
-
-    escape_char = "%"
-    charset = "utf-8"
-    errors = "strict"
-    output = ""
-    for char in str_:
-        # encode characters from encode_chars and the Separator and Other categories
-        # https://en.wikipedia.org/wiki/Unicode#General_Category_property
-        if char in encode_chars or unicodedata.category(char)[0] in {"Z", "C"}:
-            for byte in bytes(char, charset, errors):
-                output += "{}{:02X}".format(escape_char, byte)
-        else:
-            output += char
-    return output
+    if "%" in str_:
+        str_ = _PERCENT_OCTET.sub(r"%25\g<1>", str_)
+    return str_.translate(_HREF_ENCODING)
 
 # function copied from wiki-scripts:
 # https://github.com/lahwaacz/wiki-scripts/blob/master/ws/parser_helpers/encodings.py#L81-L98
@@ -143,12 +193,15 @@ def _anchor_preprocess(str_):
     # strip leading + trailing whitespace
     str_ = str_.strip()
     # squash *spaces* in the middle (other whitespace is preserved)
-    str_ = re.sub("[ ]+", " ", str_)
+    if "  " in str_:
+        str_ = re.sub("[ ]+", " ", str_)
     # leading colons are stripped, others preserved (colons in the middle preceded by
     # newline are supposed to be fucked up in MediaWiki, but this is pretty safe to ignore)
     str_ = str_.lstrip(":")
     return str_
 
+_ID_WHITESPACE = str.maketrans(" \t\n\r\f\v", "______")
+
 # adapted from `anchorencode` in wiki-scripts (the "legacy" format was removed):
 # https://github.com/lahwaacz/wiki-scripts/blob/master/ws/parser_helpers/encodings.py#L119-L152
 def anchorencode_id(str_):
@@ -157,18 +210,13 @@ def anchorencode_id(str_):
     """
     str_ = _anchor_preprocess(str_)
     # HTML5 specification says ids must not contain spaces
-    str_ = re.sub("[ \t\n\r\f\v]", "_", str_)
-    return str_
+    return str_.translate(_ID_WHITESPACE)
 
 
-def _replace_section_heading_ids(html):
+def _unique_ids():
     """
-    Replace IDs for section headings and self-links with something sensible and wiki-compatible
-
-    E.g. mandoc does not strip the "\&" roff(7) escape, may lead to duplicate underscores,
-    and sometimes uses weird encoding for some chars.
+    Section ID getter capable of handling duplicate titles
     """
-    # section ID getter capable of handling duplicate titles
     ids = set()
     def get_id(title):
         base_id = anchorencode_id(title)
@@ -179,15 +227,29 @@ def _replace_section_heading_ids(html):
             j += 1
         ids.add(id)
         return id
+    return get_id
+
+def _section_heading(heading_tag, heading_attributes, title, get_id):
+    """
+    Heading element with a sensible id and a self-link, returns (html, title, href)
+    """
+    heading_attributes = " ".join(a for a in heading_attributes.split() if not a.startswith("id="))
+    title = title.replace("\n", " ")
+    id = safe_escape_attribute(get_id(title))
+    href = anchorencode_href(id, input_is_already_id=True)
+    return f"<{heading_tag} {heading_attributes} id='{id}'><a class='permalink' href='#{href}'>{title}</a></{heading_tag}>", title, href
+
+def _replace_section_heading_ids(html):
+    """
+    Replace IDs for section headings and self-links with something sensible and wiki-compatible
+
+    E.g. mandoc does not strip the "\&" roff(7) escape, may lead to duplicate underscores,
+    and sometimes uses weird encoding for some chars.
+    """
+    get_id = _unique_ids()
 
     def repl_heading(match):
-        heading_tag = match.group("heading_tag")
-        heading_attributes = match.group("heading_attributes")
-        heading_attributes = " ".join(a for a in heading_attributes.split() if not a.startswith("id="))
-        title = match.group("title").replace("\n", " ")
-        id = safe_escape_attribute(get_id(title))
-        href = anchorencode_href(id, input_is_already_id=True)
-        return f"<{heading_tag} {heading_attributes} id='{id}'><a class='permalink' href='#{href}'>{title}</a></{heading_tag}>"
+        return _section_heading(match.group("heading_tag"), match.group("heading_attributes"), match.group("title"), get_id)[0]
 
     pattern = re.compile(r"\<(?P<heading_tag>h[1-6])(?P<heading_attributes>[^\>]*)\>[^\<\>]*"
                          r"\<a class=(\"|\')permalink(\"|\')[^\>]*\>"
@@ -220,38 +282,230 @@ def _replace_urls_in_plain_text(html):
 
 
 
-def postprocess(text, fmt):
-    if fmt == "html":
-        lang = "en"
-        xref_pattern = re.compile(r"\<(?P<tag>b|i|strong|em|mark)\>"
-                                      r"(?P<man_name>[A-Za-z0-9@._+\-:\[\]]+)"
-                                      r"\<\/\1\>"
-                                      r"\((?P<section>\d[a-z]{,3})\)")
-        #text = xref_pattern.sub("<a href='" + ROOT_URL + "man/" + r"\g<man_name>.\g<section>." + lang +
-        text = xref_pattern.sub("<a href='/man/" + r"\g<man_name>.\g<section>." + lang +
-                                        "'>\g<man_name>(\g<section>)</a>",
-                                text)
+class _Fallback(Exception):
+    """
+    Markup the single pass doesn't handle exactly like the regex chain
+    """
+    pass
+
+_TAG_SPLIT = re.compile(r"(<[^<>]*>)")
+_XREF_TAGS = {"<b>", "<i>", "<strong>", "<em>", "<mark>"}
+_XREF_NAME = re.compile(r"[A-Za-z0-9@._+\-:\[\]]+")
+_XREF_SECTION = re.compile(r"\((\d[a-z]{,3})\)")
+_BLANK = re.compile(r"(\s|&nbsp;)*")
+_HEADING_LEVELS = ("1", "2", "3", "4", "5", "6")
+_PERMALINK = re.compile(r"\<a class=(\"|\')permalink(\"|\')[^\>]*\>")
+_URL_TAG = re.compile(r"\<(b|i|strong|em|mark)[^>]*\>")
+_URL = r"(?P<url>https?://[^\s<>&]+(?<=[\w/]))"
+_TEXT_URL = re.compile(rf"(?P<angle>&lt;)?{_URL}(?(angle)&gt;|)")
+_ONLY_URL = re.compile(rf"\s*{_URL}\s*")
+
+def _url_link(match):
+    url = match.group("url")
+    return f"<a href='{url}'>{url}</a>"
+
+def _postprocess_html(html):
+    """
+    Same output as _postprocess_html_chain() and extract_headings(), in one
+    walk over the tags and texts of the page. Raises _Fallback for markup it
+    can't handle exactly like the chain (unbalanced brackets, headings or
+    <pre> inside links, ...), which mandoc doesn't produce.
+    """
+    tokens = _TAG_SPLIT.split(html) # text, tag, text, ..., text
+    if not len(tokens) // 2 == html.count("<") == html.count(">"):
+        raise _Fallback()
+
+    # every tag goes through the transforms in the order of the chain: xref
+    # links, removal of empty tags, <pre> dedent, <br/> removal, heading ids
+    # and links for urls. The text before a tag is kept until then, texts
+    # left next to each other by a removal are joined. nodes alternate text
+    # and tag, removed tags are left as "".
+    nodes = []
+    headings = []
+    get_id = _unique_ids()
+    text = tokens[0]
+    last_tag = None # for the <br/> removal
+    pre = None # contents of the open <pre>
+    skip = None # end of the <a> or <pre> being skipped by the url links
+    heading = None # position of the open <hN>
+    heading_end = None
+    angle = None # text ending with &lt; before a url link, if the next text starts with &gt;
+    n = len(tokens)
+    i = 1
+    while i < n:
+        tag = tokens[i]
+        if tag in _XREF_TAGS and i + 3 < n and tokens[i + 3][:1] == "(" and tokens[i + 2] == "</" + tag[1:] and _XREF_NAME.fullmatch(tokens[i + 1]):
+            match = _XREF_SECTION.match(tokens[i + 3])
+            if match:
+                name, section = tokens[i + 1], match.group(1)
+                tokens[i:i + 4] = f"<a href='/man/{name}.{section}.en'>", f"{name}({section})", "</a>", tokens[i + 3][match.end():]
+                tag = tokens[i]
+        blank = tokens[i + 1]
+        blank = (not blank or blank[0] == "&" or blank[0].isspace()) and i + 2 < n and tokens[i + 2][1] == "/" and _BLANK.fullmatch(blank)
+        if blank and tokens[i + 2][2:-1] and tag[1:-1].split(" ", 1)[0].startswith(tokens[i + 2][2:-1]):
+            # empty, the following newline goes too
+            if tokens[i + 3].startswith("\n"):
+                tokens[i + 3] = tokens[i + 3][1:]
+            i += 4
+            if pre is None:
+                text += tokens[i - 1]
+            else:
+                pre.append(tokens[i - 1])
+            continue
+        i += 2
+        if pre is not None:
+            if tag != "</pre>":
+                pre.append(tag)
+                pre.append(tokens[i - 1])
+                continue
+            content = "".join(pre)
+            if not content or "</div>" in content or "<h" in content or "<pre" in content:
+                raise _Fallback()
+            content = textwrap.dedent(content.strip("\n"))
+            match = _ONLY_URL.fullmatch(content)
+            if match:
+                nodes[-1] = _url_link(match)
+            else:
+                nodes.append(content)
+                nodes.append(tag)
+            pre = None
+            last_tag = tag
+            text = tokens[i - 1]
+            continue
+        if tag == "<br/>" and last_tag in ("</pre>", "</div>") and text in ("", "\n"):
+            last_tag = tag
+            text = tokens[i - 1]
+            continue
+        last_tag = tag
+
+        if angle is not None:
+            if text.startswith("&gt;"):
+                nodes[angle] = nodes[angle][:-4]
+                text = text[4:]
+            angle = None
+        if skip is None and "://" in text:
+            # a url alone in <b>, <i>, ... loses the tag
+            match = _ONLY_URL.fullmatch(text)
+            wrapper = _URL_TAG.fullmatch(nodes[-1]) if match and nodes else None
+            if wrapper and tag == f"</{wrapper.group(1)}>":
+                nodes[-1] = ""
+                if nodes[-2].endswith("&lt;"):
+                    angle = len(nodes) - 2
+                nodes.append(_url_link(match))
+                nodes.append("")
+                text = tokens[i - 1]
+                continue
+            text = _TEXT_URL.sub(_url_link, text)
+
+        kind = tag[1]
+        if skip is not None:
+            if tag == skip:
+                skip = None
+            elif (kind == "h" and tag[2:3] in _HEADING_LEVELS) or tag.startswith("<pre") or tag == heading_end:
+                raise _Fallback()
+        elif kind == "a":
+            if tag[2] not in (" ", ">"):
+                raise _Fallback()
+            skip = "</a>"
+        elif kind == "p" and tag.startswith("<pre"):
+            if tag == "<pre>":
+                pre = []
+            elif tag[4] == " ":
+                skip = "</pre>"
+            else:
+                raise _Fallback()
+        elif kind == "h" and tag[2:3] in _HEADING_LEVELS:
+            if heading is not None or tag[3] not in (" ", ">") or "://" in tag:
+                raise _Fallback()
+            heading = len(nodes) + 1
+            heading_end = f"</{tag[1:3]}>"
+        elif tag == heading_end:
+            start, heading, heading_end = heading, None, None
+            if start + 2 < len(nodes) and _PERMALINK.fullmatch(nodes[start + 2]):
+                # the first </a> must be the one before </hN>
+                end = nodes.index("</a>", start + 3)
+                if end != len(nodes) - 1 or any(node.startswith("<a") for node in nodes[start + 4:end:2]):
+                    raise _Fallback()
+                title = "".join(nodes[start + 3:end])
+                if not title or "://" in title:
+                    raise _Fallback()
+                heading_html, title, href = _section_heading(tag[2:4], nodes[start][3:-1], title, get_id)
+                nodes[start:] = [heading_html]
+                if tag[3] == "1" and href:
+                    headings.append(dict(id=normalize_html_entities(href), title=normalize_html_entities(re.sub(r"\s+", " ", title))))
+                text = tokens[i - 1]
+                continue
+        elif "://" in tag:
+            raise _Fallback()
+        nodes.append(text)
+        nodes.append(tag)
+        text = tokens[i - 1]
+        if pre is not None:
+            pre.append(text)
+            text = ""
+    if pre is not None or skip is not None:
+        raise _Fallback()
+    if angle is not None and text.startswith("&gt;"):
+        nodes[angle] = nodes[angle][:-4]
+        text = text[4:]
+    if "://" in text:
+        text = _TEXT_URL.sub(_url_link, text)
+    nodes.append(text)
+    return "".join(nodes), headings
+
+def _postprocess_html_chain(text):
+    """
+    The transforms of postprocess() as a chain of regex substitutions, used
+    for the pages _postprocess_html() doesn't handle
+    """
+    lang = "en"
+    xref_pattern = re.compile(r"\<(?P<tag>b|i|strong|em|mark)\>"
+                                  r"(?P<man_name>[A-Za-z0-9@._+\-:\[\]]+)"
+                                  r"\<\/\1\>"
+                                  r"\((?P<section>\d[a-z]{,3})\)")
+    #text = xref_pattern.sub("<a href='" + ROOT_URL + "man/" + r"\g<man_name>.\g<section>." + lang +
+    text = xref_pattern.sub("<a href='/man/" + r"\g<man_name>.\g<section>." + lang +
+                                    "'>\g<man_name>(\g<section>)</a>",
+                            text)
 
-        # remove empty tags
-        text = re.sub(r"\<(?P<tag>[^ >]+)[^>]*\>(\s|&nbsp;)*\</(?P=tag)\>\n?", "", text)
+    # remove empty tags
+    text = re.sub(r"\<(?P<tag>[^ >]+)[^>]*\>(\s|&nbsp;)*\</(?P=tag)\>\n?", "", text)
 
-        # strip leading and trailing newlines and remove common indentation
-        # from the text inside <pre> tags
-        _pre_tag_pattern = re.compile(r"\<pre\>(.+?)\</pre\>", flags=re.DOTALL)
-        text = _pre_tag_pattern.sub(lambda match: "<pre>" + textwrap.dedent(match.group(1).strip("\n")) + "</pre>", text)
+    # strip leading and trailing newlines and remove common indentation
+    # from the text inside <pre> tags
+    _pre_tag_pattern = re.compile(r"\<pre\>(.+?)\</pre\>", flags=re.DOTALL)
+    text = _pre_tag_pattern.sub(lambda match: "<pre>" + textwrap.dedent(match.group(1).strip("\n")) + "</pre>", text)
 
-        # remove <br/> tags following a <pre> or <div> tag
-        text = re.sub(r"(?<=\</(pre|div)\>)\n?<br/>", "", text)
+    # remove <br/> tags following a <pre> or <div> tag
+    text = re.sub(r"(?<=\</(pre|div)\>)\n?<br/>", "", text)
 
-        # replace URLs in plain-text with <a> links
-        #text = _replace_urls_in_plain_text(text)
+    # replace URLs in plain-text with <a> links
+    #text = _replace_urls_in_plain_text(text)
 
-        # replace IDs for section headings and self-links with something sensible and wiki-compatible
-        text = _replace_section_heading_ids(text)
+    # replace IDs for section headings and self-links with something sensible and wiki-compatible
+    text = _replace_section_heading_ids(text)
 
-        text = _replace_urls_in_plain_text(text)
+    text = _replace_urls_in_plain_text(text)
 
-        return text
+    return text
+
+def postprocess_html(text):
+    """
+    postprocess() of the html output of mandoc, returns (html, headings) with
+    the headings of extract_headings()
+    """
+    try:
+        return _postprocess_html(text)
+    except _Fallback:
+        text = _postprocess_html_chain(text)
+        return text, extract_headings(text)
+
+
+POSTPROCESS_VERSION = 1 # bump when the output of postprocess() changes, cached renderings are redone
+
+def postprocess(text, fmt):
+    if fmt == "html":
+        return postprocess_html(text)[0]
     elif fmt == "txt":
         return re.sub(".\b", "", text, flags=re.DOTALL)
 
@@ -270,6 +524,27 @@ def extract_headings(html):
         result.append(dict(id=id, title=title))
     return result
 
+_SECTION_START = re.compile(r"<section class=\"Sh\">")
+_H1_START = re.compile(r"<h1[\s>]")
+
+def split_sections(html, min_size):
+    """
+    Cut html before its top-level sections, into chunks of at least
+    `min_size` characters but the last one
+
+    Older mandoc versions don't wrap sections in <section>, their h1 headings
+    are the boundaries then.
+    """
+    starts = [m.start() for m in _SECTION_START.finditer(html)] or [m.start() for m in _H1_START.finditer(html)]
+    chunks = []
+    start = 0
+    for end in starts:
+        if end - start >= min_size:
+            chunks.append(html[start:end])
+            start = end
+    chunks.append(html[start:])
+    return chunks
+
 def extract_description(text, lang="en"):
     """
     Extracts the "description" from a plain-text version of a manual page.
@@ -332,44 +607,81 @@ def extract_description(text, lang="en"):
     description = "\n\n".join(description.split("\n\n")[:2])
     return description
 
-def resolve_so_links(db):
+def so_target(content: str) -> Union[None, tuple]:
+    """
+    (NAME, SECTION) of the page included by a page made of a single .so
+    request, None for any other page
     """
+    if ".so " not in content:
+        return None
+    stripped = re.sub(r'^\.\\".*', "", content, flags=re.MULTILINE)
+    stripped = stripped.strip()
+    if not re.fullmatch(r"^\.so [A-Za-z0-9@._+\-:\[\]\/]+\s*$", stripped):
+        return None
+    path = stripped.split()[1]
+    if path.endswith('.gz'):
+        path = path[:-3]
+    pp = PurePath(path)
+    return pp.stem, pp.suffix[1:] # strip the dot
+
+def resolve_so_links(db, updated_at):
+    """
+    Give the pages recorded in arch_so_links the contents of their target,
+    for the links whose source was written or whose target changed since they
+    were last resolved. The rendered contents of the target are reused.
+
     commit after running this !
     """
-    db.execute("""SELECT * FROM arch_manpages""")
-    res = db.fetchall()
-    for manpage in res:
-        if manpage['SO_RESOLVED'] == 1:
+    # targets in the locale of the source are preferred
+    db.execute("""SELECT l.*, t.ID AS TARGET_ID, t.CONTENT_HASH AS TARGET_HASH, t.HEADINGS, t.DESCRIPTION
+    FROM (SELECT l.SOURCE_ID AS ID, l.TARGET_NAME, l.TARGET_SECTION, l.TARGET_HASH AS RESOLVED_HASH, s.NAME, s.SECTION, s.LOCALE, s.SO_RESOLVED, c.ENCODING,
+            COALESCE((SELECT ID FROM arch_manpages WHERE NAME = l.TARGET_NAME AND SECTION = l.TARGET_SECTION AND LOCALE = s.LOCALE),
+                (SELECT ID FROM arch_manpages WHERE NAME = l.TARGET_NAME AND SECTION = l.TARGET_SECTION)) AS TARGET
+        FROM arch_so_links l
+        JOIN arch_manpages s ON s.ID = l.SOURCE_ID
+        JOIN arch_contents c ON c.ID = l.SOURCE_ID) l
+    LEFT JOIN arch_manpages t ON t.ID = l.TARGET
+    WHERE l.SO_RESOLVED = 0 OR t.CONTENT_HASH IS NOT l.RESOLVED_HASH""")
+    for link in db.fetchall():
+        if link['TARGET_ID'] is None:
+            logger.warning(f"Unknown target page: {link['TARGET_NAME']}.{link['TARGET_SECTION']}")
             continue
-        stripped = re.sub(r'^\.\\".*', "", manpage['CONTENT'], flags=re.MULTILINE)
-        stripped = stripped.strip()
-
-        # eliminate the '.so' macro
-        if re.fullmatch(r"^\.so [A-Za-z0-9@._+\-:\[\]\/]+\s*$", stripped):
-            path = stripped.split()[1]
-            if path.endswith('.gz'):
-                path = path[:-3]
-            pp = PurePath(path)
-            target_name = pp.stem
-            target_section = pp.suffix[1:]  # strip the dot
-
-            target = _get_manpage(db, target_name, target_section)
-
-            if target is None:
-                logger.warning("Unknown target page: {}".format(stripped.split()[1]))
-            else:
-                txt_content = mandoc_convert(target['CONTENT'], "txt")
-                html_content = mandoc_convert(target['CONTENT'], "html")
-                name = target['NAME']
-                section = target['SECTION']
-
-                # keep old content
-                db.execute("""UPDATE arch_manpages
-                SET TXT_CONTENT = ?,
-                HTML_CONTENT = ?,
-                SO_RESOLVED = 1
-                WHERE NAME = ? AND SECTION = ?""", (txt_content, html_content, manpage['NAME'], manpage['SECTION'],))
-                logger.info(f"Resolved .so link {manpage['NAME']}.{manpage['SECTION']} -> {target_name}.{target_section}")
+        db.execute("""SELECT ENCODING, HTML_CONTENT, TXT_CONTENT, HTML_ZSTD, TXT_ZSTD FROM arch_contents WHERE ID = ?""", (link['TARGET_ID'],))
+        target = db.fetchone()
+        txt_content = storage.decode(target['TXT_CONTENT'], target['ENCODING'])
+
+        # keep old content
+        encoding = link['ENCODING']
+        if target['ENCODING'] == encoding:
+            contents = (target['TXT_CONTENT'], target['HTML_CONTENT'], target['TXT_ZSTD'], target['HTML_ZSTD'])
+        else:
+            html_content = storage.decode(target['HTML_CONTENT'], target['ENCODING'])
+            contents = (storage.encode(txt_content, encoding), storage.encode(html_content, encoding),
+                storage.encode_zstd(txt_content, encoding), storage.encode_zstd(html_content, encoding))
+        db.execute("""UPDATE arch_contents
+        SET TXT_CONTENT = ?,
+        HTML_CONTENT = ?,
+        TXT_ZSTD = ?,
+        HTML_ZSTD = ?
+        WHERE ID = ?""", contents + (link['ID'],))
+        db.execute("""DELETE FROM arch_html_chunks WHERE ID = ?""", (link['ID'],))
+        if target['ENCODING'] == encoding:
+            db.execute("""INSERT INTO arch_html_chunks (ID, SEQ, HTML_CONTENT, HTML_ZSTD)
+            SELECT ?, SEQ, HTML_CONTENT, HTML_ZSTD FROM arch_html_chunks WHERE ID = ?""", (link['ID'], link['TARGET_ID'],))
+        else:
+            db.execute("""SELECT HTML_CONTENT FROM arch_html_chunks WHERE ID = ? ORDER BY SEQ""", (link['TARGET_ID'],))
+            chunks = storage.encode_chunks([storage.decode(row['HTML_CONTENT'], target['ENCODING']) for row in db.fetchall()], encoding)
+            db.executemany("""INSERT INTO arch_html_chunks (ID, SEQ, HTML_CONTENT, HTML_ZSTD) VALUES (?, ?, ?, ?)""",
+                ((link['ID'], seq) + chunk for seq, chunk in enumerate(chunks)))
+        db.execute("""UPDATE arch_manpages
+        SET SO_RESOLVED = 1,
+        HEADINGS = ?,
+        DESCRIPTION = ?,
+        UPDATED_AT = ?
+        WHERE ID = ?""", (link['HEADINGS'], link['DESCRIPTION'], updated_at, link['ID'],))
+        db.execute("""UPDATE arch_so_links SET TARGET_HASH = ? WHERE SOURCE_ID = ?""", (link['TARGET_HASH'], link['ID'],))
+        search.index_pages(db, [dict(link, TXT=txt_content)])
+        logger.info(f"Resolved .so link {link['NAME']}.{link['SECTION']} -> {link['TARGET_NAME']}.{link['TARGET_SECTION']}")
 
 
 
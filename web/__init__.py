@@ -1,13 +1,18 @@
+import itertools
 import os
 import sqlite3
 import re
 
 from .db import get_db
+from .cache import ResponseCache
+from .suggest import Suggestions
 
 import json
 
-from flask import Flask, render_template, abort, g, redirect, Response, current_app, request
+from flask import Flask, render_template, stream_template, stream_with_context, abort, g, redirect, Response, current_app, request, jsonify
 
+from indexer import storage
+from indexer import search as fulltext # the /search view is called search
 from indexer.util import mandoc_convert
 
 from threading import Thread
@@ -16,6 +21,9 @@ from datetime import datetime, timedelta
 
 from string import Template
 
+SEARCH_RESULTS_PER_PAGE = 20
+LISTING_PAGE_SIZE = 500
+
 class DeltaTemplate(Template):
     delimiter = "%"
 
@@ -124,6 +132,144 @@ def _get_manpage(name, section=None, lang=None):
     result = db.fetchone()
     return result # may be None
 
+def _get_content(page_id, column):
+    """
+    Fetch one of CONTENT, HTML_CONTENT or TXT_CONTENT of a page
+    """
+    db = get_db().cursor()
+    db.execute(f"""SELECT ENCODING, {column} FROM arch_contents WHERE ID = ?""", (page_id,))
+    result = db.fetchone()
+    if result is None:
+        return None
+    return storage.decode(result[column], result['ENCODING'])
+
+# gzip (or plain) and zstd columns of each format
+CONTENT_COLUMNS = {
+    "html": ("HTML_CONTENT", "HTML_ZSTD"),
+    "txt": ("TXT_CONTENT", "TXT_ZSTD"),
+    "raw": ("CONTENT", None),
+}
+CONTENT_PLACEHOLDER = "\0manpage-content\0"
+
+def _content_response(page_id, fmt, wrap=None):
+    """
+    Response with the contents of a page in `fmt`, sent as stored if the client
+    accepts gzip or zstd. `wrap` renders the rest of the page around the contents,
+    the compressed contents are spliced into it.
+    """
+    column, zstd_column = CONTENT_COLUMNS[fmt]
+    columns = ", ".join(c for c in (column, zstd_column) if c is not None)
+    db = get_db().cursor()
+    db.execute(f"""SELECT ENCODING, {columns} FROM arch_contents WHERE ID = ?""", (page_id,))
+    result = db.fetchone()
+    if result is None:
+        abort(404)
+
+    offered = []
+    if result['ENCODING'] == "gzip":
+        if zstd_column is not None and result[zstd_column] is not None:
+            offered.append("zstd")
+        offered.append("gzip")
+    coding = request.accept_encodings.best_match(offered) if offered else None
+    mimetype = "text/html" if wrap is not None else "text/plain"
+
+    if coding is None:
+        content = storage.decode(result[column], result['ENCODING'])
+        response = Response(wrap(content) if wrap is not None else content, mimetype=mimetype)
+    else:
+        blob = result[zstd_column] if coding == "zstd" else result[column]
+        if wrap is not None:
+            placeholder = CONTENT_PLACEHOLDER.encode("utf-8")
+            head, tail = wrap(CONTENT_PLACEHOLDER).encode("utf-8").split(placeholder, 1)
+            splice = storage.splice_zstd if coding == "zstd" else storage.splice_gzip
+            blob = splice(head, blob, tail)
+        response = Response(blob, mimetype=mimetype)
+        response.content_encoding = coding
+    response.vary.add("Accept-Encoding")
+    return response
+
+def _has_html_chunks(page_id):
+    db = get_db().cursor()
+    db.execute("""SELECT EXISTS(SELECT 1 FROM arch_html_chunks WHERE ID = ?)""", (page_id,))
+    return db.fetchone()[0] == 1
+
+def _iter_html_chunks(page_id, column):
+    """
+    `column` of the chunks of a page in order, read from the database one at a time
+    """
+    db = get_db().cursor()
+    db.execute(f"""SELECT {column} FROM arch_html_chunks WHERE ID = ? ORDER BY SEQ""", (page_id,))
+    for row in db:
+        yield row[0]
+
+def _chunked_response(page_id, wrap):
+    """
+    Streamed html response of a page stored in arch_html_chunks, like
+    _content_response but the page is never held in memory as a whole: the
+    start of the page is sent right away and the chunks follow as they are read.
+    """
+    db = get_db().cursor()
+    db.execute("""SELECT ENCODING FROM arch_contents WHERE ID = ?""", (page_id,))
+    result = db.fetchone()
+    if result is None:
+        abort(404)
+    encoding = result['ENCODING']
+
+    offered = ["zstd", "gzip"] if encoding == "gzip" else []
+    coding = request.accept_encodings.best_match(offered) if offered else None
+    placeholder = CONTENT_PLACEHOLDER.encode("utf-8")
+    head, tail = wrap(CONTENT_PLACEHOLDER).encode("utf-8").split(placeholder, 1)
+
+    if coding is None:
+        chunks = (storage.decode(chunk, encoding).encode("utf-8") for chunk in _iter_html_chunks(page_id, "HTML_CONTENT"))
+        body = itertools.chain([head], chunks, [tail])
+    elif coding == "zstd":
+        body = storage.stream_zstd(head, _iter_html_chunks(page_id, "HTML_ZSTD"), tail)
+    else:
+        body = storage.stream_gzip(head, _iter_html_chunks(page_id, "HTML_CONTENT"), tail)
+    response = Response(stream_with_context(body), mimetype="text/html")
+    if coding is not None:
+        response.content_encoding = coding
+    response.vary.add("Accept-Encoding")
+    return response
+
+def _parse_listing_cursor(after):
+    """
+    "name/section/locale" of the last page shown, names can't contain slashes
+    """
+    if not after:
+        return None
+    parts = after.split("/")
+    if len(parts) != 3:
+        abort(400)
+    return tuple(parts)
+
+def _iter_listing(filters, after=None, limit=LISTING_PAGE_SIZE):
+    """
+    One page of (NAME, SECTION, LOCALE) rows matching `filters` ({column:
+    value}), after the row `after` in (NAME, SECTION, LOCALE) order, all of
+    them if `limit` is None
+
+    Keyset pagination follows the arch_manpages_name_section_locale index,
+    or the (REPO, ...) and (SECTION, ...) ones of the filtered listings, so
+    every page costs the same. Nothing runs before the first row is asked
+    for, the query happens while a streamed template iterates.
+    """
+    conditions = [f"{column} = ?" for column in filters]
+    params = list(filters.values())
+    if after is not None:
+        # filtered columns are the same in every row, leaving them out lets the index seek past `after`
+        keyset = [(column, value) for column, value in zip(("NAME", "SECTION", "LOCALE"), after) if column not in filters]
+        conditions.append(f"({', '.join(column for column, _ in keyset)}) > ({', '.join('?' * len(keyset))})")
+        params += [value for _, value in keyset]
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    db = get_db().cursor()
+    db.execute(f"""SELECT NAME, SECTION, LOCALE FROM arch_manpages
+    {where}
+    ORDER BY NAME, SECTION, LOCALE
+    LIMIT ?""", params + [-1 if limit is None else limit])
+    yield from db
+
 def _count_rows(table):
     db = get_db().cursor()
     db.execute(f"""SELECT COUNT(*) from {table}""")
@@ -136,6 +282,14 @@ def _get_totals():
     symlinks = _count_rows("arch_redirects")
     return pages, symlinks, packages
 
+def _latest_execution():
+    """
+    START_TIME of the latest indexer run, changes whenever the database was updated
+    """
+    db = get_db().cursor()
+    db.execute("""SELECT MAX(START_TIME) FROM arch_executions""")
+    return db.fetchone()[0]
+
 def _get_updates():
     db = get_db().cursor()
     db.execute("""SELECT *
@@ -153,10 +307,17 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(os.path.dirname(__file__), '../packages.db'),
+        RESPONSE_CACHE_BYTES=64 * 1024 * 1024, # per worker
+        LISTING_PAGE_SIZE=LISTING_PAGE_SIZE, # None lists everything on one page, for the static export
+        SUGGEST_REFRESH_SECONDS=30,
     )
 
-    from . import db
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+
+    from . import db, export
     db.init_app(app)
+    export.init_app(app)
 
     if not os.path.exists(app.config['DATABASE']):
         from .db import run_indexer_command
@@ -202,27 +363,78 @@ def create_app(test_config=None):
     def search():
         query = request.args.get('q')
         go = (request.args.get('go') == "Go")
+        lang = request.args.get('lang', 'en')
+        page = request.args.get('page', 1, type=int)
+        if not query:
+            return render_template("search.html", title="Search", query="", lang=lang, results=[], page=1, more=False)
         result = _quicksearch(query)
         if result and go:
             return redirect(f"/man/{result['NAME']}.{result['SECTION']}")
 
-        return "Not Implemented Yet"
+        page = max(page, 1)
+        db = get_db().cursor()
+        # one more than shown tells whether there is a next page
+        results = fulltext.search(db, query, locale=lang or None, limit=SEARCH_RESULTS_PER_PAGE + 1, offset=(page - 1) * SEARCH_RESULTS_PER_PAGE)
+        more = len(results) > SEARCH_RESULTS_PER_PAGE
+        results = [dict(result, SNIPPET=fulltext.highlight(result['SNIPPET'])) for result in results[:SEARCH_RESULTS_PER_PAGE]]
+        return render_template("search.html", title=f"Search: {query}", query=query, lang=lang, results=results, page=page, more=more)
+
+    suggestions = Suggestions(app.config['SUGGEST_REFRESH_SECONDS'])
+
+    @app.route('/api/suggest')
+    def suggest():
+        query = request.args.get('q', '')
+        limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+        lang = request.args.get('lang') or None
+        index = suggestions.get(_latest_execution, lambda: get_db().cursor())
+        return jsonify([
+            dict(name=name, section=section, locale=locale, url=f"/man/{name}.{section}.{locale}")
+            for name, section, locale in index.suggest(query, limit, lang)
+        ])
+
+    def render_listing(title, filters, base_url):
+        page_size = app.config['LISTING_PAGE_SIZE']
+        if page_size is None:
+            after = None
+            manpages = _iter_listing(filters, limit=None)
+        else:
+            after = _parse_listing_cursor(request.args.get('after'))
+            # one more than shown tells whether there is a next page
+            manpages = _iter_listing(filters, after, page_size + 1)
+        return Response(stream_template("listing.html", title=title, manpages=manpages, page_size=page_size, base_url=base_url, first=after is None))
 
     @app.route('/listing')
     def listing():
-        db = get_db().cursor()
-        db.execute("""SELECT NAME, SECTION, LOCALE FROM arch_manpages
-            ORDER BY
-            NAME ASC;""")
-        result = db.fetchall()
-        #if not result:
-            # not found
-        return render_template("listing.html", manpages=result)
+        return render_listing("Listing", {}, "/listing")
+
+    @app.route('/listing/section/<section>/')
+    def listing_section(section):
+        return render_listing(f"Section {section}", {"SECTION": section}, f"/listing/section/{section}/")
 
+    @app.route('/listing/<repo>/')
+    def listing_repo(repo):
+        return render_listing(f"Repository {repo}", {"REPO": repo}, f"/listing/{repo}/")
+
+    @app.route('/listing/<repo>/<package>/')
+    def listing_package(repo, package):
+        if _get_package(package, repo) is None:
+            abort(404)
+        return render_listing(f"Package {repo}/{package}", {"REPO": repo, "PACKAGE": package}, f"/listing/{repo}/{package}/")
+
+
+    response_cache = ResponseCache(app.config['RESPONSE_CACHE_BYTES'])
 
     @app.route('/man/<path:path>')
     def manpage(path):
-        db = get_db().cursor()
+        key = (path, request.accept_encodings.best_match(["zstd", "gzip"]))
+        generation = _latest_execution()
+        response = response_cache.get(key, generation)
+        if response is None:
+            response = render_manpage(path)
+            response_cache.put(key, generation, response)
+        return response
+
+    def render_manpage(path):
         url_sections = path.split('/')
         if len(url_sections) > 1:
             abort(404)
@@ -247,15 +459,17 @@ def create_app(test_config=None):
                 return redirect(f"/man/{manpage['NAME']}.{manpage['SECTION']}" + (f".{fmt}" if fmt is not None else ""))
             else:
                 if fmt is not None and fmt != "html": # html is handled by default
-                    if fmt == "txt":
-                        return Response(manpage['TXT_CONTENT'], mimetype='text/plain')
-                    if fmt == "raw":
-                        return Response(manpage['CONTENT'], mimetype='text/plain')
+                    return _content_response(manpage['ID'], fmt)
                 name = manpage['NAME'] + '.' + manpage['SECTION']
                 pkg = _get_package(manpage['PACKAGE'], manpage['REPO'])
                 manpage = dict(manpage)
                 manpage['HEADINGS'] = json.loads(manpage['HEADINGS'])
-                return render_template('man-page.html', name=name, manpage=manpage, package=pkg,)
+                def wrap(html_content):
+                    return render_template('man-page.html', name=name, manpage=dict(manpage, HTML_CONTENT=html_content), package=pkg,)
+                if _has_html_chunks(manpage['ID']):
+                    # large pages are streamed section by section, they aren't kept in the response cache
+                    return _chunked_response(manpage['ID'], wrap)
+                return _content_response(manpage['ID'], "html", wrap)
 
     @app.errorhandler(404)
     def page_not_found(error):
@@ -0,0 +1,53 @@
+from collections import OrderedDict
+from threading import Lock
+
+from flask import Response
+
+
+class ResponseCache(object):
+    """
+    In-process LRU cache of finished responses, bounded by the size of their bodies
+
+    Every lookup passes the current generation (START_TIME of the latest indexer
+    execution), the whole cache is dropped when it changes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict() # key -> (body, status, headers)
+        self._size = 0
+        self._generation = None
+        self._lock = Lock()
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            self._entries.clear()
+            self._size = 0
+            self._generation = generation
+
+    def get(self, key, generation):
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+        body, status, headers = entry
+        return Response(body, status=status, headers=headers)
+
+    def put(self, key, generation, response: Response):
+        if response.is_streamed:
+            return
+        body = response.get_data()
+        if len(body) > self._max_bytes:
+            return
+        with self._lock:
+            self._check_generation(generation)
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[0])
+            self._entries[key] = (body, response.status_code, list(response.headers.items()))
+            self._size += len(body)
+            while self._size > self._max_bytes:
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
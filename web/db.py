@@ -5,7 +5,7 @@ from flask import current_app, g
 from flask.cli import with_appcontext
 
 import asyncio
-from indexer.indexer import main
+from indexer.indexer import main, MIRRORLIST, REPOS
 
 def get_db():
     if 'db' not in g:
@@ -21,8 +21,10 @@ def close_db(e=None):
         db.close()
 
 @click.command('run-indexer')
-def run_indexer_command():
-    asyncio.run(main())
+@click.option('--repo', 'repos', multiple=True, default=REPOS, show_default=True, help='Repository to index, can be repeated.')
+@click.option('--mirrorlist', default=MIRRORLIST, type=click.Path(exists=True, dir_okay=False), help='pacman mirrorlist to download from.')
+def run_indexer_command(repos, mirrorlist):
+    asyncio.run(main(list(repos), mirrorlist))
     click.echo("Ran the indexer.")
 
 def init_app(app):
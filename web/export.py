@@ -0,0 +1,238 @@
+"""
+Static export of the whole site, so that it can be served without Python
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+
+from concurrent.futures import ProcessPoolExecutor
+from html import escape
+from urllib.parse import quote
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from tqdm import tqdm
+
+STAMP_FILE = ".export-stamp" # START_TIME of the exported indexer execution
+MANIFEST_FILE = ".export-manifest" # pages, redirects and listings of that export
+CHUNK_SIZE = 500 # urls per worker task
+FORMATS = ["html", "txt", "raw"]
+
+_client = None # test client of the worker process
+
+
+def _init_worker(database):
+    global _client
+    from . import create_app
+    # static files can't take ?after=, listings are written as a single page
+    _client = create_app({"DATABASE": database, "RESPONSE_CACHE_BYTES": 0, "LISTING_PAGE_SIZE": None}).test_client()
+
+def _redirect_stub(location):
+    location = escape(location)
+    return (f"<!DOCTYPE html>\n<html><head><meta charset=\"UTF-8\"><meta http-equiv=\"refresh\" content=\"0; url={location}\">"
+            f"<link rel=\"canonical\" href=\"{location}\"></head>"
+            f"<body><a href=\"{location}\">{location}</a></body></html>\n")
+
+def _write(output, file, data):
+    path = os.path.join(output, file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+def _export(output, urls):
+    """
+    Request (url, file) pairs from the app and write the responses under `output`
+    """
+    written = 0
+    for url, file in urls:
+        response = _client.get(url)
+        if response.status_code in (301, 302, 303, 307, 308):
+            data = _redirect_stub(response.headers['Location']).encode("utf-8")
+        elif response.status_code == 200:
+            data = response.get_data()
+        else:
+            continue
+        _write(output, file, data)
+        written += 1
+    return written
+
+def _page_urls(name, section, locale):
+    """
+    (url, file) pairs of a page, nginx is expected to try $uri.html for urls without a format
+    """
+    quoted = quote(name)
+    for fmt in FORMATS:
+        yield f"/man/{quoted}.{section}.{locale}.{fmt}", f"man/{name}.{section}.{locale}.{fmt}"
+        yield f"/man/{quoted}.{section}.{fmt}", f"man/{name}.{section}.{fmt}"
+    yield f"/man/{quoted}", f"man/{name}.html"
+
+def _listing_urls(db, since=None):
+    """
+    (url, file) pairs of the listings, of those with pages updated since
+    `since` if it isn't None
+    """
+    yield "/listing", "listing.html"
+    updated = "" if since is None else "WHERE UPDATED_AT > ?"
+    params = () if since is None else (since,)
+    db.execute(f"""SELECT DISTINCT REPO FROM arch_manpages {updated}""", params)
+    for repo, in db.fetchall():
+        yield f"/listing/{quote(repo)}/", f"listing/{repo}/index.html"
+    db.execute(f"""SELECT DISTINCT REPO, PACKAGE FROM arch_manpages {updated}""", params)
+    for repo, package in db.fetchall():
+        yield f"/listing/{quote(repo)}/{quote(package)}/", f"listing/{repo}/{package}/index.html"
+    db.execute(f"""SELECT DISTINCT SECTION FROM arch_manpages {updated}""", params)
+    for section, in db.fetchall():
+        yield f"/listing/section/{quote(section)}/", f"listing/section/{section}/index.html"
+
+def _manifest(db):
+    """
+    What the database exports to, compared with the previous manifest to
+    find what disappeared since
+    """
+    db.execute("""SELECT REPO, PACKAGE, NAME, SECTION, LOCALE FROM arch_manpages""")
+    pages = [tuple(row) for row in db.fetchall()]
+    db.execute("""SELECT SOURCE_NAME, SOURCE_SECTION, SOURCE_LANG, TARGET_NAME FROM arch_redirects""")
+    redirects = [tuple(row) for row in db.fetchall()]
+    listings = [file for _, file in _listing_urls(db)]
+    return {"pages": pages, "redirects": redirects, "listings": listings}
+
+def _manifest_files(manifest):
+    files = set(manifest["listings"])
+    files.add("index.html")
+    for _, _, name, section, locale in manifest["pages"]:
+        files.update(file for _, file in _page_urls(name, section, locale))
+    for name, section, lang, _ in manifest["redirects"]:
+        files.add(f"man/{name}.{section}.{lang}.html")
+        files.add(f"man/{name}.{section}.html")
+    return files
+
+def _read_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return {
+        "pages": [tuple(page) for page in manifest["pages"]],
+        "redirects": [tuple(redirect) for redirect in manifest["redirects"]],
+        "listings": manifest["listings"],
+    }
+
+def _remove(output, file):
+    """
+    Remove `file` and the directories it leaves empty under `output`
+    """
+    output = os.path.normpath(output)
+    path = os.path.join(output, file)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    directory = os.path.dirname(path)
+    while directory != output and not os.listdir(directory):
+        os.rmdir(directory)
+        directory = os.path.dirname(directory)
+
+def _read_stamp(output):
+    try:
+        with open(os.path.join(output, STAMP_FILE)) as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def export_static(database, output, jobs, full=False):
+    """
+    Export the pages updated since the last export to `output`, or everything
+    if `full` or there is no previous export
+
+    The files of pages, redirects and listings that were exported before but
+    are gone from the database are removed, they are found by comparing the
+    manifest written next to the stamp with the database.
+    """
+    con = sqlite3.connect(database)
+    con.row_factory = sqlite3.Row
+    db = con.cursor()
+    db.execute("""SELECT MAX(START_TIME) FROM arch_executions""")
+    latest = db.fetchone()[0] or 0
+    previous = _read_manifest(output)
+    # without a manifest there is no telling what was removed since the stamp
+    since = None if full or previous is None else _read_stamp(output)
+    current = _manifest(db)
+    listings = {file: url for url, file in _listing_urls(db)}
+
+    files = {"index.html": "/"}
+    if since is None:
+        click.echo(f"Exporting everything to {output}")
+        pages = current["pages"]
+        db.execute("""SELECT * FROM arch_redirects""")
+        redirects = db.fetchall()
+        files.update(listings)
+    else:
+        click.echo(f"Exporting pages updated since {since} to {output}")
+        removed_pages = set(previous["pages"]) - set(current["pages"])
+        removed_redirects = set(previous["redirects"]) - set(current["redirects"])
+        # the urls of other pages with the same name may resolve differently now
+        db.execute("""SELECT NAME FROM arch_manpages WHERE UPDATED_AT > ?
+            UNION SELECT TARGET_NAME FROM arch_redirects WHERE UPDATED_AT > ?
+        """, (since, since,))
+        names = {row[0] for row in db.fetchall()}
+        names.update(page[2] for page in removed_pages)
+        names.update(redirect[3] for redirect in removed_redirects)
+        pages = [page for page in current["pages"] if page[2] in names]
+        db.execute("""SELECT * FROM arch_redirects WHERE UPDATED_AT > ?""", (since,))
+        redirects = db.fetchall()
+        for url, file in _listing_urls(db, since):
+            files[file] = url
+        # listings that lost a page, unless they are gone as well
+        for repo, package, _, section, _ in removed_pages:
+            for file in (f"listing/{repo}/index.html", f"listing/{repo}/{package}/index.html", f"listing/section/{section}/index.html"):
+                if file in listings:
+                    files[file] = listings[file]
+    con.close()
+
+    for _, _, name, section, locale in pages:
+        for url, file in _page_urls(name, section, locale):
+            files[file] = url
+    urls = [(url, file) for file, url in files.items()]
+
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "static"), os.path.join(output, "static"), dirs_exist_ok=True)
+    for redirect in redirects:
+        target = f"/man/{quote(redirect['TARGET_NAME'])}.{redirect['TARGET_SECTION']}.{redirect['TARGET_LANG']}"
+        stub = _redirect_stub(target).encode("utf-8")
+        _write(output, f"man/{redirect['SOURCE_NAME']}.{redirect['SOURCE_SECTION']}.{redirect['SOURCE_LANG']}.html", stub)
+        _write(output, f"man/{redirect['SOURCE_NAME']}.{redirect['SOURCE_SECTION']}.html", stub)
+
+    written = 0
+    chunks = [urls[i:i + CHUNK_SIZE] for i in range(0, len(urls), CHUNK_SIZE)]
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("forkserver"), initializer=_init_worker, initargs=(database,)) as pool:
+        with tqdm(total=len(urls), unit="url") as pbar:
+            for chunk, count in zip(chunks, pool.map(_export, [output] * len(chunks), chunks)):
+                written += count
+                pbar.update(len(chunk))
+
+    stale = _manifest_files(previous) - _manifest_files(current) if previous is not None else set()
+    for file in stale:
+        _remove(output, file)
+
+    _write(output, MANIFEST_FILE, json.dumps(current).encode("utf-8"))
+    with open(os.path.join(output, STAMP_FILE), "w") as f:
+        f.write(str(latest))
+    click.echo(f"Wrote {written} files and {len(redirects) * 2} redirect stubs, removed {len(stale)} files")
+
+@click.command('export-static')
+@click.option('--output', default='static-site', show_default=True, help='Directory to write the site to.')
+@click.option('--jobs', default=os.cpu_count() or 1, show_default=True, help='Number of worker processes.')
+@click.option('--full', is_flag=True, help='Export everything, not only pages changed since the last export.')
+@with_appcontext
+def export_static_command(output, jobs, full):
+    """
+    Write the site to OUTPUT as plain files (try_files $uri $uri.html $uri/index.html in nginx)
+    """
+    export_static(current_app.config['DATABASE'], output, jobs, full)
+
+def init_app(app):
+    app.cli.add_command(export_static_command)
@@ -0,0 +1,36 @@
+// Name suggestions for the search box, from /api/suggest
+(function () {
+	var box = document.querySelector("input.searchbox");
+	if (!box) {
+		return;
+	}
+	var list = document.createElement("datalist");
+	list.id = "search-suggestions";
+	box.setAttribute("list", list.id);
+	box.setAttribute("autocomplete", "off");
+	box.parentNode.appendChild(list);
+
+	var pending = null;
+	box.addEventListener("input", function () {
+		var query = box.value.trim();
+		if (pending) {
+			pending.abort();
+		}
+		if (!query) {
+			list.replaceChildren();
+			return;
+		}
+		pending = new AbortController();
+		fetch("/api/suggest?q=" + encodeURIComponent(query), {signal: pending.signal})
+			.then(function (response) { return response.json(); })
+			.then(function (suggestions) {
+				list.replaceChildren.apply(list, suggestions.map(function (suggestion) {
+					var option = document.createElement("option");
+					option.value = suggestion.name + "." + suggestion.section;
+					option.label = suggestion.name + "(" + suggestion.section + ") [" + suggestion.locale + "]";
+					return option;
+				}));
+			})
+			.catch(function () {});
+	});
+})();
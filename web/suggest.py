@@ -0,0 +1,156 @@
+import time
+
+from bisect import bisect_left
+from heapq import nsmallest
+from threading import Lock
+
+# sorts after every character man page names contain
+_MAX_CHAR = "\U0010ffff"
+
+
+class NameIndex(object):
+    """
+    Sorted array of lowercased page names, used as an implicit trie
+
+    The keys starting with a prefix form a contiguous range, found with
+    bisect, so prefix queries and the edit distance search over the trie
+    need no structure besides the array.
+    """
+
+    def __init__(self, rows):
+        entries = {}
+        for name, section, locale in rows:
+            entries.setdefault(name.lower(), set()).add((name, section, locale))
+        self._keys = sorted(entries)
+        self._entries = [sorted(entries[key]) for key in self._keys]
+
+    @classmethod
+    def from_db(cls, db):
+        db.execute("""SELECT NAME, SECTION, LOCALE FROM arch_manpages
+        UNION SELECT SOURCE_NAME, SOURCE_SECTION, SOURCE_LANG FROM arch_redirects""")
+        return cls(db.fetchall())
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _range(self, prefix: str, lo: int = 0, hi: int = None) -> tuple[int, int]:
+        if hi is None:
+            hi = len(self._keys)
+        return bisect_left(self._keys, prefix, lo, hi), bisect_left(self._keys, prefix + _MAX_CHAR, lo, hi)
+
+    def _in_locale(self, i: int, locale: str) -> bool:
+        return locale is None or any(entry[2] == locale for entry in self._entries[i])
+
+    def _prefix(self, query: str, limit: int, locale: str = None) -> list:
+        lo, hi = self._range(query)
+        # shortest names first, "ls" is a better guess than "lsblk" for "ls"
+        return nsmallest(limit, (i for i in range(lo, hi) if self._in_locale(i, locale)),
+                         key=lambda i: (len(self._keys[i]), self._keys[i]))
+
+    @staticmethod
+    def _next_row(query: str, prefix: str, char: str, row: list, previous_row: list) -> list:
+        """
+        Edit distances between the prefixes of `query` and prefix + char,
+        given those for prefix (row) and prefix[:-1] (previous_row).
+        Transpositions count as one edit.
+        """
+        next_row = [row[0] + 1]
+        for k, query_char in enumerate(query, 1):
+            distance = min(next_row[k - 1] + 1, row[k] + 1, row[k - 1] + (query_char != char))
+            if k > 1 and prefix and query_char == prefix[-1] and query[k - 2] == char:
+                distance = min(distance, previous_row[k - 2] + 1)
+            next_row.append(distance)
+        return next_row
+
+    def _fuzzy(self, query: str, max_distance: int) -> list:
+        """
+        (distance, lo, hi) of the key ranges starting with a string within
+        `max_distance` edits of `query`, ranges can be nested
+
+        The first character is taken as typed, which keeps the search small.
+        """
+        keys = self._keys
+        found = []
+
+        def visit(prefix, lo, hi, row, previous_row):
+            # row[i]: edit distance between query[:i] and prefix
+            if row[-1] <= max_distance:
+                found.append((row[-1], lo, hi))
+            if min(row) > max_distance:
+                return
+            depth = len(prefix)
+            i = lo
+            if i < hi and len(keys[i]) == depth:
+                i += 1 # the key equal to prefix has no children
+            while i < hi:
+                char = keys[i][depth]
+                _, j = self._range(prefix + char, i, hi)
+                visit(prefix + char, i, j, self._next_row(query, prefix, char, row, previous_row), row)
+                i = j
+
+        lo, hi = self._range(query[0])
+        initial_row = list(range(len(query) + 1))
+        visit(query[0], lo, hi, self._next_row(query, "", query[0], initial_row, None), initial_row)
+        return found
+
+    def suggest(self, query: str, limit: int = 10, locale: str = None) -> list:
+        """
+        (NAME, SECTION, LOCALE) of names starting with `query`, followed by
+        names starting with a few typos of it for queries of 3+ characters
+
+        With a `locale`, names without a page in it are skipped before ranking,
+        so they don't take the places of names that have one.
+        """
+        query = query.lower()
+        if not query:
+            return []
+        ranked = self._prefix(query, limit, locale)
+        max_distance = 0 if len(query) < 3 else 1 if len(query) < 8 else 2
+        if len(ranked) < limit and max_distance:
+            seen = set(ranked)
+            ranges = self._fuzzy(query, max_distance)
+            for distance in range(1, max_distance + 1):
+                candidates = {i for d, lo, hi in ranges if d == distance for i in range(lo, hi)} - seen
+                candidates = {i for i in candidates if self._in_locale(i, locale)}
+                ranked += nsmallest(limit - len(ranked), candidates, key=lambda i: (len(self._keys[i]), self._keys[i]))
+                seen.update(candidates)
+                if len(ranked) >= limit:
+                    break
+
+        results = []
+        for i in ranked:
+            results += [entry for entry in self._entries[i] if locale is None or entry[2] == locale]
+        return results[:limit]
+
+
+class Suggestions(object):
+    """
+    Keeps a NameIndex in step with the database
+
+    The START_TIME of the latest indexer execution is checked at most every
+    `refresh_seconds`, the index is rebuilt when it changed. Queries in
+    between don't touch the database.
+    """
+
+    def __init__(self, refresh_seconds: float):
+        self._refresh_seconds = refresh_seconds
+        self._index = None
+        self._generation = None
+        self._checked = 0.0
+        self._lock = Lock()
+
+    def get(self, latest_execution, db) -> NameIndex:
+        """
+        latest_execution: callable returning the current generation
+        db: callable returning a cursor, only called to (re)build the index
+        """
+        if self._index is not None and time.monotonic() - self._checked < self._refresh_seconds:
+            return self._index
+        with self._lock:
+            if self._index is None or time.monotonic() - self._checked >= self._refresh_seconds:
+                generation = latest_execution()
+                if self._index is None or generation != self._generation:
+                    self._index = NameIndex.from_db(db())
+                    self._generation = generation
+                self._checked = time.monotonic()
+        return self._index